@@ -75,6 +75,8 @@ create table checkin_hour (
     fk_day_id int not null,
     hour time not null,
     total_checkins int not null,
+    -- The natural key, so a batch replayed after resuming from a checkpoint conflicts instead of counting twice.
+    unique (fk_day_id, hour),
     foreign key (fk_day_id) references checkin_day(day_id)
 );
 
@@ -100,6 +102,8 @@ create table review (
     useful int,
     funny int,
     cool int,
+    -- Generated, so every insert and COPY of the loader fills it without the loader knowing about it.
+    text_search tsvector generated always as (to_tsvector('english', coalesce(text, ''))) stored,
     primary key (review_id),
     foreign key (fk_business_id) references business(business_id),
     foreign key (fk_user_id) references yelp_user(user_id)
@@ -113,6 +117,69 @@ create table friend (
     foreign key (fk_friend_id) references yelp_user(user_id)
 );
 
+-- Indexes for the GUI queries (py_files/Milestone3Queries.py, checked with py_files/Milestone3Explain.py).
+-- State -> city -> zipcode drill-down and the categories of a zipcode.
+create index business_location_idx on business (state, city, fk_zipcode);
+-- No index on num_checkins: the GUI reads the rankings from zipcode_popular/zipcode_successful, and one would make
+-- every update_num_checkins update of business a non-HOT update. The rankings refresh finds a zipcode's businesses
+-- through business_zipcode_name_idx and sorts them itself.
+-- Businesses of a category.
+create index business_categories_category_idx on business_categories (fk_category, fk_business_id);
+-- A zipcode's businesses in (name, business_id) order, so a page of a category's businesses starts without a sort.
+create index business_zipcode_name_idx on business (fk_zipcode, name, business_id);
+-- checkin_day lookups by business already use the index of unique (fk_business_id, day).
+-- Full-text search of review text, and the reviews of the businesses a search is scoped to.
+create index review_text_search_idx on review using gin (text_search);
+create index review_business_idx on review (fk_business_id);
+
+-- Per-zipcode rankings the GUI reads instead of ranking business on every click (the top_10_* views below, stored).
+-- Milestone3DB.refresh_zipcode_rankings recomputes the zipcodes whose businesses a load touched; after writes made
+-- outside the loader, run python Kyle_Lim_parseJSON.py --refresh-summaries to recompute every zipcode.
+-- Top 10 businesses of each zipcode by check-ins.
+create table zipcode_popular (
+    fk_zipcode char(5) not null,
+    rank int not null,
+    business_id varchar(100) not null,
+    name varchar(100),
+    stars decimal(2,1),
+    review_count int,
+    num_checkins int,
+    primary key (fk_zipcode, rank)
+);
+
+-- Businesses in the top half of their zipcode by check-ins with at least 4 stars.
+create table zipcode_successful (
+    fk_zipcode char(5) not null,
+    business_id varchar(100) not null,
+    name varchar(100),
+    stars decimal(2,1),
+    review_count int,
+    primary key (fk_zipcode, business_id)
+);
+
+-- Per-zipcode statistics and category counts for the GUI's zipcode panel and category list, recomputed by
+-- Milestone3DB.refresh_zipcode_summaries for the zipcodes whose businesses a load touched. Writes made outside the
+-- loader need a full refresh: python Kyle_Lim_parseJSON.py --refresh-summaries.
+create table zipcode_summary (
+    fk_zipcode char(5) primary key,
+    median_income int,
+    population int,
+    business_count int not null,
+    total_checkins int not null,
+    total_reviews int not null,
+    average_stars decimal(3,2)
+);
+
+-- A zipcode can span cities, so its categories are counted per state and city.
+create table zipcode_category_summary (
+    fk_zipcode char(5) not null,
+    state varchar(100) not null,
+    city varchar(100) not null,
+    fk_category varchar(50) not null,
+    business_count int not null,
+    primary key (fk_zipcode, state, city, fk_category)
+);
+
 /*create view avg_income_global as
 -- Collapse all incomes in zipcode on avg_income.
 select
@@ -226,6 +293,10 @@ where
 create or replace function update_total_average_count_stars()
 returns trigger as $update_business_stars$
     begin
+        -- A bulk load's own sessions skip this and recompute business in one pass at the end.
+        if current_setting('milestone3.bulk_load', true) = 'on' then
+            return new;
+        end if;
         update business
         set total_stars = total_stars + new.stars,
             review_count = review_count + 1,
@@ -245,6 +316,9 @@ execute function update_total_average_count_stars();
 create or replace function update_total_checkins()
 returns trigger as $update_business_checkins$
     begin
+        if current_setting('milestone3.bulk_load', true) = 'on' then
+            return new;
+        end if;
         update business
         set num_checkins = num_checkins + new.total_checkins
         from checkin_day
@@ -1,15 +1,28 @@
 import sys
-import psycopg2
+import time
 from PyQt6.QtCore import Qt
 from PyQt6.QtWidgets import QApplication, QWidget, QComboBox, QLabel, QListWidget, QMessageBox, \
-    QGridLayout, QFrame, QVBoxLayout, QTableWidget, QTableWidgetItem, QHeaderView, QPushButton
+    QGridLayout, QFrame, QVBoxLayout, QTableView, QHeaderView, QPushButton, QLineEdit
 from PyQt6.uic.properties import QtWidgets
 
+from Milestone3DB import DATA_LOADED_CHANNEL
+from Milestone3QueryExecutor import Milestone3QueryExecutor
+from Milestone3TableModel import Milestone3TableModel
+
+# Businesses are shown a page at a time, and the next page is read when the table is scrolled to the bottom.
+BUSINESS_PAGE_SIZE = 200
+
 
 class MilestoneApp(QWidget):
-    def __init__(self):
+    def __init__(self, prefetch=False, cache_size=1024, query_stats=False):
         super().__init__()
-        self.conn = None
+        self.executor = None
+        # The state/city/zipcode/category lists and zipcode statistics are cached. With prefetch, the whole
+        # hierarchy is read in one query at startup (and again after every load) so navigating it never waits.
+        self.prefetch = prefetch
+        self.cache_size = cache_size
+        # Print the calls and latency of every query when the window closes.
+        self.query_stats = query_stats
         self.init_ui()
 
     def init_ui(self):
@@ -60,14 +73,25 @@ class MilestoneApp(QWidget):
 
         # Add Popular businesses
         self.popular_label = QLabel('Popular: ')
-        self.popular_list = QTableWidget()
+        self.popular_list = QTableView()
+        self.popular_model = Milestone3TableModel(['{}', 'Stars: {}', 'Reviews: {}'])
+        self.popular_list.setModel(self.popular_model)
 
         # Add Successful businesses
         self.successful_label = QLabel('Successful: ')
-        self.successful_list = QTableWidget()
+        self.successful_list = QTableView()
+        self.successful_model = Milestone3TableModel(['{}', 'Stars: {}', 'Reviews: {}'])
+        self.successful_list.setModel(self.successful_model)
 
         grid_layout.addWidget(self.set_business_lists(), 2, 0, 1, 2)
 
+        # Add the review search. Matching businesses of the selected state, city and zipcode go in the business table.
+        self.search_label = QLabel('Search Reviews: ')
+        self.search_box = QLineEdit()
+        self.search_button = QPushButton('Search')
+        self.search_status = QLabel('')
+        grid_layout.addWidget(self.set_search(), 3, 0)
+
         self.refresh_classification_button = QPushButton('Refresh Popular/Successful')
         grid_layout.addWidget(self.refresh_classification_button, 3, 1)
 
@@ -76,10 +100,6 @@ class MilestoneApp(QWidget):
         # Connect to the database.
         self.connect_db()
 
-        # Update components to populate with values.
-        self.update_state_combo()
-        self.update_city_list()
-
         # Register listeners to the states combobox and the cities list.
         self.distinct_states_combo.currentIndexChanged.connect(self.update_city_list)
         self.cities_list.itemClicked.connect(self.update_zipcode_list)
@@ -87,12 +107,20 @@ class MilestoneApp(QWidget):
         self.categories_list.itemClicked.connect(self.update_business_table)
         self.refresh_classification_button.clicked.connect(self.update_successful)
         self.refresh_classification_button.clicked.connect(self.update_popular)
+        self.search_box.returnPressed.connect(self.update_search)
+        self.search_button.clicked.connect(self.update_search)
+
+        # Update components to populate with values. The states arrive in the background, and selecting the first
+        # one loads its cities.
+        if self.prefetch:
+            self.prefetch_hierarchy()
+        self.update_state_combo()
 
     def clear_business_table(self):
-        self.business_table.clearContents()
+        self.business_model.clear()
+        self.search_status.clear()
 
     def add_classifier_tables(self, classifier_label, classifier_table):
-        classifier_table.setColumnCount(3)
         for i in range(3):
             classifier_table.setColumnWidth(i, 200)
 
@@ -104,10 +132,12 @@ class MilestoneApp(QWidget):
     def add_business_table(self):
         # Add the business table.
         self.business_label = QLabel('Business: ')
-        self.business_table = QTableWidget()
-
-        # Set number of columns in the table.
-        self.business_table.setColumnCount(6)
+        # The table only renders the rows that are visible, so big categories fill instantly.
+        self.business_table = QTableView()
+        self.business_model = Milestone3TableModel(['{}', '{}', '{}', 'Stars: {}', 'Reviews: {}',
+                                                    'Total Check-ins: {}'], self.fetch_more_businesses)
+        self.business_params = None
+        self.business_table.setModel(self.business_model)
 
         # Set the width of the city and state column.
         for i in range(6):
@@ -124,183 +154,193 @@ class MilestoneApp(QWidget):
         # Create a new container for this item.
         return self.container(self.business_label, self.business_table)
 
-    # Connect to the PostgreSQL database.
+    # Connect to the PostgreSQL database. Queries run in the background on a small pool of connections.
     def connect_db(self):
         try:
-            self.conn = psycopg2.connect(
+            self.executor = Milestone3QueryExecutor(
+                max_connections=4,
+                cache_size=self.cache_size,
                 host='localhost',
                 dbname='milestone3db',
                 user='postgres',
                 password='',
                 port=5432
             )
+            self.executor.failed.connect(self.show_query_error)
+            # The loader notifies after every load, which clears the cache.
+            self.executor.invalidated.connect(self.data_loaded)
+            self.executor.invalidate_on(DATA_LOADED_CHANNEL)
         except Exception as e:
             QMessageBox.critical(self, 'Could not connect to the database:', str(e))
 
+    def data_loaded(self):
+        if self.prefetch:
+            self.prefetch_hierarchy()
+
+    def prefetch_hierarchy(self):
+        if self.executor is None:
+            return
+
+        # A load that finishes while the hierarchy is being read makes it stale, and then it isn't cached.
+        cache_version = self.executor.cache.version
+        self.executor.submit('hierarchy', 'hierarchy', (),
+                             lambda rows: self.cache_hierarchy(rows, cache_version))
+
+    def cache_hierarchy(self, rows, cache_version):
+        # Build the result every hierarchy query would return from the one prefetched result. The rows are distinct
+        # and already in the database's order, and the dicts keep that order, so nothing is sorted here: Python would
+        # sort by codepoint, not by the collation the uncached queries sort with.
+        states = {}
+        for state, city, zipcode, category in rows:
+            categories = states.setdefault(state, {}).setdefault(city, {}).setdefault(zipcode, [])
+            if category is not None:
+                categories.append(category)
+
+        # The most specific results go in first, so when the hierarchy doesn't fit the cache, the LRU evicts
+        # categories before it evicts cities or states.
+        entries = []
+        for state, cities in states.items():
+            for city, zipcodes in cities.items():
+                for zipcode, categories in zipcodes.items():
+                    entries.append(('categories', (state, city, zipcode),
+                                    [(category,) for category in categories]))
+        for state, cities in states.items():
+            for city, zipcodes in cities.items():
+                entries.append(('zipcodes', (state, city), [(zipcode,) for zipcode in zipcodes]))
+        for state, cities in states.items():
+            entries.append(('cities', (state,), [(city,) for city in cities]))
+        entries.append(('states', (), [(state,) for state in states]))
+        self.executor.cache.put_many(entries, cache_version)
+
+    def show_query_error(self, key, generation, message):
+        # Errors of queries that were superseded in the meantime don't matter anymore.
+        if self.executor.is_current(key, generation):
+            QMessageBox.warning(self, 'Warning:', message)
+
+    def closeEvent(self, event):
+        if self.executor is not None:
+            self.executor.close()
+            if self.query_stats:
+                self.executor.registry.report()
+        super().closeEvent(event)
+
     def update_state_combo(self):
-        if self.conn is None:
+        if self.executor is None:
             QMessageBox.warning(self, 'Warning', "Could not connect to the database.")
+            return
 
-        try:
-            # Execute the command: SELECT DISTINCT state FROM business;
-            cursor = self.conn.cursor()
-            cursor.execute('select distinct state from business;')
-            distinct_states = cursor.fetchall()
-            cursor.close()
-
-            # Populate the state combo box.
-            for state in distinct_states:
-                self.distinct_states_combo.addItems(state)
+        # Execute the command: SELECT DISTINCT state FROM business;
+        self.executor.submit('states', 'states', (), self.show_states, cache=True)
 
-            self.cities_list.clear()
-            self.clear_business_table()
-            self.clear_zipcode_statistics()
+    def show_states(self, distinct_states):
+        self.cities_list.clear()
+        self.clear_business_table()
+        self.clear_zipcode_statistics()
 
-        except Exception as e:
-            QMessageBox.warning(self, 'Warning:', str(e))
+        # Populate the state combo box. Selecting the first state loads its cities.
+        for state in distinct_states:
+            self.distinct_states_combo.addItems(state)
 
     def update_city_list(self):
-        # Clear the list of cities every time a state is changed.
+        # Clear the list of cities every time a state is changed, along with everything below it.
         self.cities_list.clear()
+        self.categories_list.clear()
+        self.clear_business_table()
+        self.clear_zipcode_statistics()
+        self.zipcode_list.clear()
 
-        if self.conn is None:
+        if self.executor is None:
             QMessageBox.warning(self, 'Warning', "Could not connect to the database.")
+            return
 
         # Get the current state selected.
         current_state = self.distinct_states_combo.currentText()
 
-        try:
-            cursor = self.conn.cursor()
-
-            # Execute the command: SELECT DISTINCT city FROM business WHERE state=[selected state] ORDER BY city
-            cursor.execute('select distinct city from business where state=%s order by city;', (current_state,))
-
-            # Get the cities from the cursor.
-            cities = cursor.fetchall()
-            cursor.close()
-
-            # Update the cities in the list.
-            for city in cities:
-                self.cities_list.addItems(city)
+        # Queries still running for the old state would fill in views that were just cleared.
+        self.executor.cancel('zipcodes', 'categories', 'businesses', 'zipcode_statistics')
+        # Execute the command: SELECT DISTINCT city FROM business WHERE state=[selected state] ORDER BY city
+        self.executor.submit('cities', 'cities', (current_state,), self.show_cities, cache=True)
 
-            self.categories_list.clear()
-            self.clear_business_table()
-            self.clear_zipcode_statistics()
-            self.zipcode_list.clear()
-
-        except Exception as e:
-            QMessageBox.warning(self, 'Warning:', str(e))
+    def show_cities(self, cities):
+        # Update the cities in the list.
+        for city in cities:
+            self.cities_list.addItems(city)
 
     def update_zipcode_list(self):
         self.clear_zipcode_statistics()
         self.zipcode_list.clear()
+        self.categories_list.clear()
+        self.clear_business_table()
 
-        if self.conn is None:
+        if self.executor is None:
             QMessageBox().warning(self, 'Warning', "Could not connect to the database.")
+            return
 
         current_state = self.distinct_states_combo.currentText()
         current_city = self.cities_list.currentItem().text()
 
-        try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
-                    select distinct fk_zipcode from business
-                    where state = %s and city = %s
-                    order by fk_zipcode
-            """, (current_state, current_city))
-
-                zipcodes = cursor.fetchall()
-
-                for zipcode in zipcodes:
-                    self.zipcode_list.addItems(zipcode)
+        self.executor.cancel('categories', 'businesses', 'zipcode_statistics')
+        self.executor.submit('zipcodes', 'zipcodes', (current_state, current_city), self.show_zipcodes,
+                             cache=True)
 
-                self.categories_list.clear()
-                self.clear_business_table()
-                cursor.close()
-        except Exception as e:
-            QMessageBox.warning(self, 'Warning:', str(e))
+    def show_zipcodes(self, zipcodes):
+        for zipcode in zipcodes:
+            self.zipcode_list.addItems(zipcode)
 
     def update_categories_list(self):
         self.categories_list.clear()
+        self.clear_business_table()
+        if self.executor is None:
+            QMessageBox.warning(self, 'Warning', "Could not connect to the database.")
+            return
+
         self.update_zipcode_statistics()
         current_state = self.distinct_states_combo.currentText()
         current_city = self.cities_list.currentItem().text()
         current_zip = self.zipcode_list.currentItem().text()
 
-        try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
-                    select distinct bc.fk_category
-                    from business b
-                    inner join business_categories bc 
-                    on b.business_id = bc.fk_business_id
-                    where b.state = %s and b.city = %s and b.fk_zipcode = %s 
-                    order by bc.fk_category
-                """, (current_state, current_city, current_zip))
-
-                categories = cursor.fetchall()
-
-                for category in categories:
-                    self.categories_list.addItem(category[0])
+        self.executor.cancel('businesses')
+        self.executor.submit('categories', 'categories', (current_state, current_city, current_zip),
+                             self.show_categories, cache=True)
 
-                cursor.close()
-                self.clear_business_table()
-
-        except Exception as e:
-            QMessageBox.warning(self, 'Warning:', str(e))
+    def show_categories(self, categories):
+        for category in categories:
+            self.categories_list.addItem(category[0])
 
     def update_business_table(self):
-        # We want to set the row count to zero as the clear function doesn't clear all the rows from the table.
         self.clear_business_table()
-        self.business_table.setRowCount(0)
 
-        if self.conn is None:
+        if self.executor is None:
             QMessageBox.warning(self, 'Warning', "Could not connect to the database.")
+            return
 
         # Get the current city and state.
         current_state = self.distinct_states_combo.currentText()
         current_zip = self.zipcode_list.currentItem().text()
         current_category = self.categories_list.currentItem().text()
 
-        try:
-            businesses = []
-            cursor = self.conn.cursor()
-            # Execute the command: SELECT name, state, city FROM business WHERE state=[select state] AND city=[select city] ORDER BY name;
-            cursor.execute("""
-                select name, address, city, stars, review_count, num_checkins
-                from business b
-                inner join business_categories bc
-                on b.business_id = bc.fk_business_id
-                where state = %s and fk_zipcode = %s and bc.fk_category = %s
-                order by (name)
-            """, (current_state, current_zip, current_category))
-            businesses = cursor.fetchall()
-
-            # There are a lot of values being updated here. It follows we don't want to display all these changes.
-            self.business_table.setUpdatesEnabled(False)
-            for business in businesses:
-                self.add_business(self.business_table, business)
-            # Re-enable updates in the business table to show the changes.
-            self.business_table.setUpdatesEnabled(True)
+        self.business_params = (current_state, current_zip, current_category)
+        self.executor.submit('businesses', 'businesses', self.business_params, self.show_businesses,
+                             fetch_size=BUSINESS_PAGE_SIZE)
 
-        except Exception as e:
-            QMessageBox.warning(self, 'Warning:', str(e))
-
-    def add_business(self, table, business):
-        # The sql command returns a list of tuples, that is, (name,state,city).
-        name, address, city, stars, review_count, num_checkins = business
-        stars = str(stars)
-        num_checkins = str(num_checkins)
-        review_count = str(review_count)
-        current_row = table.rowCount()
-        # Create a new row at the last index and insert appropriate values.
-        table.insertRow(current_row)
-        table.setItem(current_row, 0, QTableWidgetItem(name))
-        table.setItem(current_row, 1, QTableWidgetItem(address))
-        table.setItem(current_row, 2, QTableWidgetItem(city))
-        table.setItem(current_row, 3, QTableWidgetItem("Stars: " + stars))
-        table.setItem(current_row, 4, QTableWidgetItem("Reviews: " + review_count))
-        table.setItem(current_row, 5, QTableWidgetItem("Total Check-ins: " + num_checkins))
+    def show_businesses(self, businesses):
+        # Rows are (name, address, city, stars, review_count, num_checkins, business_id).
+        self.business_model.set_rows(businesses, has_more=len(businesses) == BUSINESS_PAGE_SIZE)
+
+    def fetch_more_businesses(self, last_business):
+        # The next page starts after the last business shown. Under the same key, so choosing another category
+        # supersedes it.
+        name, business_id = last_business[0], last_business[6]
+        self.executor.submit('businesses', 'businesses_page', self.business_params + (name, business_id),
+                             self.show_more_businesses, fetch_size=BUSINESS_PAGE_SIZE,
+                             error_callback=self.business_page_failed)
+
+    def show_more_businesses(self, businesses):
+        self.business_model.append_rows(businesses, has_more=len(businesses) == BUSINESS_PAGE_SIZE)
+
+    def business_page_failed(self, message):
+        # show_query_error reports the message; the table only has to stop waiting for the page.
+        self.business_model.fetch_failed()
 
     def clear_zipcode_statistics(self):
         self.zip_label.clear()
@@ -313,124 +353,80 @@ class MilestoneApp(QWidget):
         self.zip_business_count.setText('Business Count: N/A')
 
     def update_zipcode_statistics(self):
-        if self.conn is None:
+        if self.executor is None:
             QMessageBox.warning(self, 'Warning', "Could not connect to the database.")
+            return
 
         current_zip = self.zipcode_list.currentItem().text()
-        try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
-                    select median_income, population
-                    from zipcode where zipcode = %s
-                """, (current_zip,))
-                zip_statistics = cursor.fetchall()
-                if zip_statistics is None:
-                    return
-
-                self.zip_label.clear()
-                self.zip_median.clear()
-                self.zip_population.clear()
-                median_income, population = zip_statistics[0]
-                self.zip_label.setText(f'Zipcode: {current_zip}')
-                self.zip_population.setText(f'Population: {population}')
-                self.zip_median.setText(f'Median Income: ${median_income}')
-
-                cursor.execute("""
-                    select count(*) from business b 
-                    where fk_zipcode = %s
-                """, (current_zip,))
-                self.zip_business_count.setText(f'Business Count: {cursor.fetchall()[0][0]}')
-        except Exception as e:
-            QMessageBox.warning(self, 'Warning:', str(e))
+        self.executor.submit('zipcode_statistics', 'zipcode_statistics', (current_zip,),
+                             lambda zip_statistics: self.show_zipcode_statistics(current_zip, zip_statistics),
+                             cache=True)
+
+    def show_zipcode_statistics(self, current_zip, zip_statistics):
+        if not zip_statistics:
+            return
+
+        self.zip_label.clear()
+        self.zip_median.clear()
+        self.zip_population.clear()
+        self.zip_business_count.clear()
+        median_income, population, business_count = zip_statistics[0]
+        self.zip_label.setText(f'Zipcode: {current_zip}')
+        self.zip_population.setText(f'Population: {population}')
+        self.zip_median.setText(f'Median Income: ${median_income}')
+        self.zip_business_count.setText(f'Business Count: {business_count}')
+
+    def update_search(self):
+        self.clear_business_table()
+
+        if self.executor is None:
+            QMessageBox.warning(self, 'Warning', "Could not connect to the database.")
+            return
+
+        search = self.search_box.text().strip()
+        if not search:
+            return
+
+        # Search the narrowest selection there is: the whole state when no city is selected yet.
+        current_state = self.distinct_states_combo.currentText()
+        current_city = self.cities_list.currentItem().text() if self.cities_list.currentItem() else None
+        current_zip = self.zipcode_list.currentItem().text() if self.zipcode_list.currentItem() else None
+
+        # Under the business table's key, so choosing a category supersedes a search and the other way around.
+        started = time.perf_counter()
+        self.search_status.setText('Searching...')
+        self.executor.submit('businesses', 'search', (search, current_state, current_city, current_zip),
+                             lambda businesses: self.show_search_results(businesses, started))
+
+    def show_search_results(self, businesses, started):
+        # The latency the user sees: from the click to the results arriving back on the GUI thread.
+        elapsed = (time.perf_counter() - started) * 1000
+        self.business_model.set_rows(businesses)
+        self.search_status.setText(f'{len(businesses)} businesses in {elapsed:.0f} ms')
 
     def update_popular(self):
+        if self.executor is None:
+            QMessageBox.warning(self, 'Warning', "Could not connect to the database.")
+            return
+
         zipcode = self.zipcode_list.currentItem().text()
-        try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
-                    with partition as (
-                        select
-                            name,
-                            stars,
-                            review_count,
-                            business_id,
-                            num_checkins,
-                            fk_zipcode,
-                            city,
-                            row_number() over (partition by fk_zipcode order by num_checkins desc) as rn
-                        from business
-                        where fk_zipcode = %s
-                    )
-                    select name, stars, review_count
-                    from partition
-                    where rn <= 10
-                """, (zipcode,))
-                popular = cursor.fetchall()
-                self.popular_list.setRowCount(0)
-                self.popular_list.clear()
-                for pop in popular:
-                    self.add_to_classification_tables(self.popular_list, pop)
+        self.executor.submit('popular', 'popular', (zipcode,), self.show_popular)
 
-        except Exception as e:
-            QMessageBox.warning(self, 'Warning:', str(e))
+    def show_popular(self, popular):
+        # Rows are (name, stars, review_count).
+        self.popular_model.set_rows(popular)
 
     def update_successful(self):
+        if self.executor is None:
+            QMessageBox.warning(self, 'Warning', "Could not connect to the database.")
+            return
+
         zipcode = self.zipcode_list.currentItem().text()
-        try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("""
-                    with partitioned_vals as (
-                    select
-                        fk_zipcode,
-                        business_id,
-                        num_checkins,
-                        stars,
-                        row_number() over (partition by fk_zipcode order by num_checkins desc) as rn,
-                        count(*) over (partition by fk_zipcode) as business_count
-                    from business
-                ),
-                median_half as (
-                    select
-                        fk_zipcode,
-                        business_id,
-                        num_checkins,
-                        stars,
-                        rn,
-                        count(*) over (partition by fk_zipcode) as business_count
-                    from partitioned_vals pv
-                    where rn <= (business_count + 1) / 2
-                )
-                select
-                    b.name,
-                    b.stars,
-                    b.review_count
-                from business b
-                left join median_half mh on b.business_id = mh.business_id
-                where b.fk_zipcode = %s
-                and mh.stars >= 4.0
-                and mh.business_id is not null
-                order by b.stars desc;
-                """, (zipcode, ))
-
-                successful = cursor.fetchall()
-                self.successful_list.setRowCount(0)
-                self.successful_list.clear()
-                for success in successful:
-                    self.add_to_classification_tables(self.successful_list, success)
+        self.executor.submit('successful', 'successful', (zipcode,), self.show_successful)
+
+    def show_successful(self, successful):
+        self.successful_model.set_rows(successful)
 
-        except Exception as e:
-            QMessageBox.warning(self, 'Warning:', str(e))
-
-    def add_to_classification_tables(self, table, business):
-        name, stars, review_count = business
-        stars = str(stars)
-        review_count = str(review_count)
-        current_row = table.rowCount()
-        # Create a new row at the last index and insert appropriate values.
-        table.insertRow(current_row)
-        table.setItem(current_row, 0, QTableWidgetItem(name))
-        table.setItem(current_row, 1, QTableWidgetItem("Stars: " + stars))
-        table.setItem(current_row, 2, QTableWidgetItem("Reviews: " + review_count))
     def set_zipcode_statistics(self):
         layout = QGridLayout()
         layout.addWidget(self.zip_label, 0, 0)
@@ -472,6 +468,21 @@ class MilestoneApp(QWidget):
         bg.setLayout(layout)
         return bg
 
+    def set_search(self):
+        layout = QGridLayout()
+        layout.addWidget(self.search_label, 0, 0)
+        layout.addWidget(self.search_box, 0, 1)
+        layout.addWidget(self.search_button, 0, 2)
+        layout.addWidget(self.search_status, 0, 3)
+        bg = QFrame(self)
+        bg.setStyleSheet(f"""
+            background-color: #f0f0f0;
+                    border: 1px solid #d1d1d1;
+                    border-radius: 1px;
+        """)
+        bg.setLayout(layout)
+        return bg
+
     def set_business_lists(self):
         layout = QGridLayout()
         layout.addWidget(self.add_business_table(), 0, 0, 1, 2)
@@ -530,7 +541,10 @@ class MilestoneApp(QWidget):
 
 
 if __name__ == '__main__':
+    # python Kyle_Lim_GUI.py [--prefetch] [--cache-size=1024] [--query-stats]
+    cache_size = [int(arg[len('--cache-size='):]) for arg in sys.argv if arg.startswith('--cache-size=')]
     app = QApplication(sys.argv)
-    ex = MilestoneApp()
+    ex = MilestoneApp(prefetch='--prefetch' in sys.argv, cache_size=cache_size[0] if cache_size else 1024,
+                      query_stats='--query-stats' in sys.argv)
     ex.show()
     sys.exit(app.exec())
@@ -1,36 +1,284 @@
-import json
+import multiprocessing
 import os
+import queue
 import random
+import sys
 import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
 
+from Milestone3Checkpoint import Milestone3Checkpoint
 from Milestone3DB import Milestone3DB
+from Milestone3Decoder import Milestone3Decoder
+from Milestone3FriendGraph import Milestone3FriendGraph
+from Milestone3Metrics import Milestone3Metrics
 
 # -------------------------------- Emoticons --------------------------------------------
 emoticons = ['ಥ_ಥ', '(╬ ಠ益ಠ)', 'ლ(｀ー´ლ)', '(╯°□°）╯︵ ┻━┻', '༼∵༽ ༼⍨༽ ༼⍢༽ ༼⍤༽', '༼ ༎ຶ ෴ ༎ຶ༽', '{ಠʖಠ}']
 
+
+# ---------------------------------- Columns -----------------------------------------------------------------
+# The row builders emit tuples in this column order and Milestone3DB takes the column list alongside them, so a row is
+# never built as a dict and then copied into a tuple again for the insert.
+COLUMNS = {
+    'business': ['business_id', 'name', 'address', 'city', 'state', 'fk_zipcode', 'latitude', 'longitude', 'stars',
+                 'total_stars', 'review_count', 'num_checkins'],
+    'categories': ['category'],
+    'business_categories': ['fk_business_id', 'fk_category'],
+    'business_hours': ['fk_business_id', 'day_of_week', 'hours'],
+    'review': ['review_id', 'fk_user_id', 'fk_business_id', 'stars', 'date', 'text', 'useful', 'funny', 'cool'],
+    'yelp_user': ['user_id', 'name', 'yelping_since', 'review_count', 'fans', 'average_stars', 'funny', 'useful',
+                  'cool'],
+    'friend': ['fk_user_id', 'fk_friend_id'],
+    'checkin_day': ['day', 'fk_business_id'],
+    'checkin_hour': ['fk_day_id', 'total_checkins', 'hour'],
+}
+
+
+# ---------------------------------- Phases -----------------------------------------------------------------
+# The input file of each loader phase and the phases holding the rows its foreign keys point at. Phases run as soon as
+# their dependencies are loaded: businesses and users together, then reviews, checkins and friends.
+PHASE_FILES = {
+    'businesses': 'yelp_business.JSON',
+    'users': 'yelp_user.JSON',
+    'friends': 'yelp_user.JSON',
+    'reviews': 'yelp_review.JSON',
+    'checkins': 'yelp_checkin.JSON',
+}
+PHASE_DEPENDENCIES = {
+    'businesses': [],
+    'users': [],
+    'friends': ['users'],
+    'reviews': ['businesses', 'users'],
+    'checkins': ['businesses'],
+}
+
+# The keys each phase's row builder reads. With used_fields_only the decoder drops everything else.
+PHASE_FIELDS = {
+    'businesses': ['business_id', 'name', 'address', 'city', 'state', 'postal_code', 'latitude', 'longitude',
+                   'categories', 'hours'],
+    'users': ['user_id', 'name', 'yelping_since', 'review_count', 'fans', 'average_stars', 'funny', 'useful', 'cool'],
+    'friends': ['user_id', 'friends'],
+    'reviews': ['review_id', 'user_id', 'business_id', 'stars', 'date', 'text', 'useful', 'funny', 'cool'],
+    'checkins': ['business_id', 'time'],
+}
+
+
+class Phase:
+    # One loader phase while it runs. pending counts the batches handed to the workers and not written yet, so the
+    # phase is done once its reader has queued everything and pending is back to 0.
+    def __init__(self, name, dependencies):
+        self.name = name
+        self.dependencies = dependencies
+        self.build_rows = None
+        self.write_rows = None
+        self.message = ''
+        self.pending = 0
+        self.read = False
+        self.started = None
+        self.done = threading.Event()
+
+
+# ---------------------------------- Build Rows -----------------------------------------------------------------
+# These are plain functions rather than methods so a process pool can pickle them. on_item is called once per JSON
+# object and drives the loading bar when the rows are built on a loader thread.
+def clean_str_4_sql(s):
+    return s.replace("'", "''").replace("\n", " ")
+
+
+def business_rows(data, on_item=None):
+    business_batch = []
+    category_batch = []
+    business_category_batch = []
+    business_hours_batch = []
+    for datum in data:
+        business = clean_str_4_sql(datum['business_id'])  # business id
+        business_batch.append((
+            business,
+            clean_str_4_sql(datum['name']),
+            clean_str_4_sql(datum['address']),
+            clean_str_4_sql(datum['city']),
+            clean_str_4_sql(datum['state']),
+            datum['postal_code'],
+            datum['latitude'],
+            datum['longitude'],
+            0,  # stars
+            0,  # total_stars
+            0,  # review_count
+            0,  # num_checkins
+        ))
+
+        # process business categories
+        for category in datum['categories']:
+            category = clean_str_4_sql(category)
+            category_batch.append((category,))
+            business_category_batch.append((business, category))
+
+        # process business hours
+        for (day, hours) in datum['hours'].items():
+            business_hours_batch.append((business, clean_str_4_sql(day), clean_str_4_sql(hours)))
+
+        if on_item is not None:
+            on_item()
+
+    return business_batch, category_batch, business_category_batch, business_hours_batch
+
+
+def review_rows(data, on_item=None):
+    review_batch = []
+    for datum in data:
+        review_batch.append((
+            clean_str_4_sql(datum['review_id']),
+            clean_str_4_sql(datum['user_id']),
+            clean_str_4_sql(datum['business_id']),
+            datum['stars'],
+            datum['date'],
+            clean_str_4_sql(datum['text']),
+            datum['useful'],
+            datum['funny'],
+            datum['cool'],
+        ))
+        if on_item is not None:
+            on_item()
+    return review_batch
+
+
+def user_rows(data, on_item=None):
+    user_batch = []
+    for datum in data:
+        user_batch.append((
+            clean_str_4_sql(datum['user_id']),
+            clean_str_4_sql(datum['name']),
+            clean_str_4_sql(datum['yelping_since']),
+            datum['review_count'],
+            datum['fans'],
+            datum['average_stars'],
+            datum['funny'],
+            datum['useful'],
+            datum['cool'],
+        ))
+        if on_item is not None:
+            on_item()
+    return user_batch
+
+
+def friend_rows(data, on_item=None):
+    friend_batch = []
+    for datum in data:
+        user_id = clean_str_4_sql(datum['user_id'])
+        for friend in datum['friends']:
+            friend_batch.append((user_id, clean_str_4_sql(friend)))
+        if on_item is not None:
+            on_item()
+    return friend_batch
+
+
+def checkin_rows(data, on_item=None):
+    # checkin_hour rows need the serial day_id of their checkin_day row, which only exists once the days are
+    # inserted. Until then they are (fk_business_id, day, total_checkins, hour) and ParseJSON.resolve_checkin_hours
+    # swaps the first two for fk_day_id.
+    checkin_day_batch = []
+    checkin_hour_batch = []
+    for datum in data:
+        business_id = clean_str_4_sql(datum['business_id'])
+        for day, times in datum['time'].items():
+            day_of_week = clean_str_4_sql(day)
+            checkin_day_batch.append((day_of_week, business_id))
+            for hour, count in times.items():
+                checkin_hour_batch.append((business_id, day_of_week, count, clean_str_4_sql(hour)))
+        if on_item is not None:
+            on_item()
+    return checkin_day_batch, checkin_hour_batch
+
+
+def parse_lines(build_rows, lines, decoder):
+    # Runs in a worker process: decode and build there, and only send the finished rows back.
+    started = time.perf_counter()
+    rows = build_rows([decoder.decode(line) for line in lines])
+    return len(lines), time.perf_counter() - started, rows
+
+
 class ParseJSON:
-    def __init__(self, num_threads):
+    def __init__(self, num_threads, stream=False, batch_size=1000, copy_tables=None, processes=False,
+                 bulk_load=False, checkpoint=None, input_dir='../yelpInput', metrics_path=None, friend_graph=False,
+                 parallel_phases=True, decoder=None, used_fields_only=False, drop_constraints=False):
         self.num_threads = num_threads if num_threads is not None else os.cpu_count() - 2
+        # Streaming reads the files in batch_size pieces instead of loading them whole. Either way the threads pull
+        # work units of batch_size items. The process pool and checkpoints both work on streamed batches.
+        self.stream = stream or processes or checkpoint is not None
+        # With processes, JSON decoding and row building move into a pool of num_threads processes (which implies
+        # streaming) and the num_threads loader threads only write.
+        self.processes = processes
+        # A bulk load skips the per-row business triggers in its own sessions and recomputes the aggregates once at the
+        # end.
+        self.bulk_load = bulk_load
+        # Drop the foreign keys and secondary indexes of the loaded tables first and rebuild them once at the end.
+        self.drop_constraints = drop_constraints
+        # A Milestone3Checkpoint lets a streamed load pick up after its last committed batch.
+        self.checkpoint = checkpoint
+        self.input_dir = input_dir
+        # Where to write the metrics when the load ends: Prometheus text for .prom, JSON otherwise.
+        self.metrics_path = metrics_path
+        # The friend graph loader writes each friendship once instead of once per direction and drops friends that
+        # aren't in the user file. Queries have to check both columns of friend to find a user's friends.
+        self.friend_graph = friend_graph
+        # Run phases side by side as PHASE_DEPENDENCIES allows, or strictly one after another.
+        self.parallel_phases = parallel_phases
+        self.phases = {}
+        self.memory_data = {}
         self.lock = threading.Lock()
-        self.iteration = 0
+        # Businesses whose rows, reviews or checkins this load wrote; their zipcodes' rankings and summaries are
+        # refreshed at the end.
+        self.touched_businesses = set()
+        # decoder names a Milestone3Decoder backend ('orjson', 'simdjson', 'json'); None picks the fastest installed.
+        self.decoder = Milestone3Decoder(decoder)
+        self.used_fields_only = used_fields_only
+        self.batch_size = batch_size
+        self.stream_error = None
+        # Tables listed here are loaded with COPY instead of insert statements.
+        self.copy_tables = set(copy_tables) if copy_tables is not None else set()
+        self.metrics = Milestone3Metrics(self.num_threads)
         self.item_count = 0
-        self.barrier = threading.Barrier(self.num_threads)
+        # The loading bar is redrawn from the metrics every refresh_seconds by its own thread, not on every row.
+        self.refresh_seconds = 0.2
+        self.progress_message = ''
+        self.loading_bar_stop = None
+        self.loading_bar_thread = None
         self.emoticon = ''
         print('Using %d threads' % self.num_threads)
+        print(f'Decoding JSON with {self.decoder.name}')
 
     # ------------------------- Helper Methods ------------------------------------------------------
     def update_emoticon(self):
         self.emoticon = random.choice(emoticons)
 
-    def thread_safe_increment(self, message, thread_idx=0):
-        if thread_idx == 0:
-            self.loading_bar(message)
-        with self.lock:
-            self.iteration += 1
+    def thread_safe_increment(self, thread_idx=0):
+        self.metrics.add_items(thread_idx)
+
+    def reset_progress(self):
+        self.metrics.reset_items()
+
+    def start_loading_bar(self):
+        self.loading_bar_stop = threading.Event()
+        self.loading_bar_thread = threading.Thread(target=self.refresh_loading_bar, args=(self.loading_bar_stop,))
+        self.loading_bar_thread.daemon = True
+        self.loading_bar_thread.start()
+
+    def stop_loading_bar(self):
+        self.loading_bar_stop.set()
+        self.loading_bar_thread.join()
+        self.loading_bar(self.progress_message)
+
+    def refresh_loading_bar(self, stop):
+        while not stop.wait(self.refresh_seconds):
+            self.loading_bar(self.progress_message)
 
     def loading_bar(self, message, length=100):
         static_item_count = self.item_count
-        static_iteration = self.iteration if (100 * self.iteration / float(
+        if static_item_count == 0:
+            return
+        iteration = self.metrics.items_done()
+        static_iteration = iteration if (100 * iteration / float(
             static_item_count)) < 99 else static_item_count
         percent = ("{0:.2f}").format(100 * (static_iteration / float(static_item_count)))
         filled_length = int(length * static_iteration // static_item_count)
@@ -41,8 +289,22 @@ class ParseJSON:
         bar_with_message = bar[:message_position] + message + bar[message_position:]
         print(f'\r{bar_with_message}|{percent}%', end='\r', flush=True)
 
+    def update_progress_message(self):
+        # The loading bar names every phase that is running.
+        self.progress_message = ' + '.join([phase.message for phase in self.phases.values()
+                                            if phase.started is not None and not phase.done.is_set()])
+
+    def progress_callback(self, thread_idx):
+        return lambda: self.thread_safe_increment(thread_idx)
+
+    def build(self, thread_idx, build_rows, data):
+        started = time.perf_counter()
+        rows = build_rows(data, self.progress_callback(thread_idx))
+        self.metrics.record_parse(thread_idx, time.perf_counter() - started)
+        return rows
+
     def clean_str_4_sql(self, s):
-        return s.replace("'", "''").replace("\n", " ")
+        return clean_str_4_sql(s)
 
     def get_attributes(self, attributes):
         L = []
@@ -53,251 +315,489 @@ class ParseJSON:
                 L.append((attribute, value))
         return L
 
-    def json_to_memory(self, file_path, print_statement):
+    def insert_rows(self, db, connection, table, rows, conflict_columns=None, sort_columns=None):
+        if table in self.copy_tables:
+            db.copy_batch(connection, table, rows, conflict_columns=conflict_columns, columns=COLUMNS[table],
+                          sort_columns=sort_columns)
+        else:
+            db.insert_batch(connection, table, rows, conflict_columns=conflict_columns, columns=COLUMNS[table],
+                            sort_columns=sort_columns)
+
+    def json_to_memory(self, file_path, print_statement, decoder=None):
+        decoder = decoder if decoder is not None else self.decoder
         print(f'\nParsing {print_statement}...\n')
         data = []
         count_line = 0
         with open(file_path, 'r') as f:
             for line in f:
-                data.append(json.loads(line))
+                data.append(decoder.decode(line))
                 count_line += 1
             f.close()
         print(f'{count_line} {print_statement} in memory.')
         return data
 
+    def line_batches(self, file_path, batch_size, offset=0):
+        # Yield (end offset, lines) a batch at a time so only the batches waiting in the queue are ever in memory. The
+        # file is read as bytes so the offsets are exact and can go into the checkpoint manifest.
+        batch = []
+        with open(file_path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                offset += len(line)
+                batch.append(line)
+                if len(batch) == batch_size:
+                    yield offset, batch
+                    batch = []
+        if batch:
+            yield offset, batch
+
+    def json_batches(self, file_path, batch_size, offset=0, decoder=None):
+        decoder = decoder if decoder is not None else self.decoder
+        for end_offset, lines in self.line_batches(file_path, batch_size, offset):
+            yield end_offset, [decoder.decode(line) for line in lines]
+
+    def count_lines(self, file_path, offset=0):
+        # The loading bar needs a total up front. Counting raw lines is cheap and doesn't decode anything.
+        with open(file_path, 'rb') as f:
+            f.seek(offset)
+            return sum(1 for _ in f)
+
     # ---------------------------------- Run Threads -----------------------------------------------------------------
-    def run_threads(self):
-        db = Milestone3DB('localhost', 'milestone3db', 'postgres', '', 5432)
-        db.create_connection_pool(self.num_threads)
-        self.update_emoticon()
-        data = self.json_to_memory('../yelpInput/yelp_business.JSON', 'businesses')
-        self.start_threads(self.parse_business_data, data, db)
-        self.update_emoticon()
-        data = self.json_to_memory('../yelpInput/yelp_user.JSON', 'users')
-        self.start_threads(self.parse_user_data, data, db)
-        self.update_emoticon()
-        self.iteration = 0
-        data = self.json_to_memory('../yelpInput/yelp_review.JSON', 'reviews')
-        self.start_threads(self.parse_review_data, data, db)
-        self.update_emoticon()
-        data = self.json_to_memory('../yelpInput/yelp_checkin.JSON', 'checkins')
-        self.start_threads(self.parse_checkin_data, data, db)
-        print(f'Parsed {len(data)} checkins')
+    def input_path(self, file_name):
+        return os.path.join(self.input_dir, file_name)
 
-    def start_threads(self, function, items, db):
-        self.iteration = 0
+    def run_threads(self, db=None):
+        if db is None:
+            db = Milestone3DB('localhost', 'milestone3db', 'postgres', '', 5432)
         if self.num_threads < 2:
             self.num_threads = 2
-        chunks = self.get_chunks(items)
-        threads = []
-        for i in range(self.num_threads):
-            thread = threading.Thread(target=function, args=(i, chunks[i], db))
-            threads.append(thread)
-            thread.start()
-
-        for thread in threads:
-            thread.join()
-
-        print()
+        # A caller that passes its own db (the benchmark) may already have a pool of num_threads connections.
+        if db.connection_pool is None:
+            db.create_connection_pool(self.num_threads)
+        if len(self.metrics.items) != self.num_threads:
+            self.metrics = Milestone3Metrics(self.num_threads)
+        db.metrics = self.metrics
+        self.metrics.start()
+        try:
+            self.restore_pending_constraints(db)
+            if self.drop_constraints:
+                self.run_with_constraints_dropped(db)
+            else:
+                self.run_load(db)
+        finally:
+            if self.metrics_path is not None:
+                self.metrics.write(self.metrics_path)
+
+    def run_phases(self, db):
+        if self.processes:
+            # forkserver, not fork: the pool's processes start on the first submit, while the worker and loading bar
+            # threads run, and forking a process with threads running can deadlock the child.
+            with ProcessPoolExecutor(max_workers=self.num_threads,
+                                     mp_context=multiprocessing.get_context('forkserver')) as executor:
+                self.run_phase_graph(db, executor)
+        else:
+            self.run_phase_graph(db)
+
+    def run_load(self, db):
+        self.touched_businesses = set()
+        try:
+            if self.bulk_load:
+                self.run_bulk_load(db)
+            else:
+                self.run_phases(db)
+        finally:
+            self.refresh_rankings(db)
+            self.notify_data_loaded(db)
 
-    def get_chunks(self, items):
-        # // Is the floor division operator. We need this to avoid indices that are out of bounds.
-        # Set the item count as a chunk, we'll count with one thread.
-        self.item_count = len(items)
-        chunk_size = chunk_size = len(items) // self.num_threads
-        # Create individual chunks inside the chunks list appending a total of chunk_size items to the sub-list.
-        chunks = [items[i * chunk_size:(i + 1) * chunk_size] for i in range(self.num_threads)]
-        # Get the leftover items - items[self.num_threads * chunk_size:]
-        leftover = items[self.num_threads * chunk_size:]
-        # Place the remainders in the chunks.
-        for i, item in enumerate(leftover):
-            chunks[i].append(item)
-
-        return chunks
-
-    # ---------------------------------- Parse Data -----------------------------------------------------------------
-    def parse_business_data(self, thread_idx, data, db):
+    def refresh_rankings(self, db):
+        if not self.touched_businesses:
+            return
+        print(f'\nRefreshing zipcode rankings and summaries for {len(self.touched_businesses)} businesses...')
         connection = db.get_connection()
-        business_batch = []
-        category_batch = []
-        business_category_batch = []
-        business_hours_batch = []
         try:
-            for i in range(len(data)):
-                datum = data[i]
-                business = datum['business_id']  # business id
-                business_batch.append({
-                    'business_id': self.clean_str_4_sql(business),
-                    'name': self.clean_str_4_sql(datum['name']),
-                    'address': self.clean_str_4_sql(datum['address']),
-                    'city': self.clean_str_4_sql(datum['city']),
-                    'state': self.clean_str_4_sql(datum['state']),
-                    'fk_zipcode': datum['postal_code'],
-                    'latitude': datum['latitude'],
-                    'longitude': datum['longitude'],
-                    'stars': 0,
-                    'total_stars': 0,
-                    'review_count': 0,
-                    'num_checkins': 0
-                })
-
-                # process business categories
-                for category in datum['categories']:
-                    category_batch.append({
-                        'category': self.clean_str_4_sql(category),
-                    })
-                    business_category_batch.append({
-                        'fk_business_id': self.clean_str_4_sql(business),
-                        'fk_category': self.clean_str_4_sql(category),
-                    })
-
-                # process business hours
-                for (day, hours) in datum['hours'].items():
-                    business_hours_batch.append({
-                        'fk_business_id': self.clean_str_4_sql(business),
-                        'day_of_week': self.clean_str_4_sql(day),
-                        'hours': self.clean_str_4_sql(hours)
-                    })
-
-                message = 'ADDING BUSINESSES'
-                self.thread_safe_increment(message, thread_idx)
+            db.refresh_zipcode_rankings(connection, self.touched_businesses)
+            db.refresh_zipcode_summaries(connection, self.touched_businesses)
+        finally:
+            db.release_connection(connection)
 
-            with self.lock:
-                db.insert_batch(connection, 'business', business_batch, conflict_columns=['business_id'])
-            self.barrier.wait()
-            with self.lock:
-                db.insert_batch(connection, 'categories', category_batch, conflict_columns=['category'])
-            self.barrier.wait()
-            with self.lock:
-                db.insert_batch(connection, 'business_categories', business_category_batch,
-                                conflict_columns=['fk_business_id', 'fk_category'])
-            self.barrier.wait()
-            with self.lock:
-                db.insert_batch(connection, 'business_hours', business_hours_batch,
-                                conflict_columns=['fk_business_id', 'day_of_week'])
+    def refresh_all(self, db=None):
+        # A load only refreshes the rankings and summaries of the zipcodes it touched. Anything else that writes
+        # business, review, checkin or zipcode rows (psql, Kyle_Lim_UPDATE.sql, another application) leaves them stale
+        # until this recomputes every zipcode; run it with --refresh-summaries.
+        if db is None:
+            db = Milestone3DB('localhost', 'milestone3db', 'postgres', '', 5432)
+        if db.connection_pool is None:
+            db.create_connection_pool(1)
+        print('Refreshing zipcode rankings and summaries for every zipcode...')
+        connection = db.get_connection()
+        try:
+            db.refresh_zipcode_rankings(connection, None)
+            db.refresh_zipcode_summaries(connection, None)
         finally:
-            self.barrier.wait()
             db.release_connection(connection)
+        self.notify_data_loaded(db)
 
-    def parse_review_data(self, thread_idx, data, db):
+    def notify_data_loaded(self, db):
+        # Also after a failed load, since the batches committed before the failure are new data too.
         connection = db.get_connection()
-        review_batch = []
-        for i in range(len(data)):
-            datum = data[i]
-            review_batch.append({
-                'review_id': self.clean_str_4_sql(datum['review_id']),
-                'fk_user_id': self.clean_str_4_sql(datum['user_id']),
-                'fk_business_id': self.clean_str_4_sql(datum['business_id']),
-                'stars': datum['stars'],
-                'date': datum['date'],
-                'text': self.clean_str_4_sql(datum['text']),
-                'useful': (datum['useful']),
-                'funny': (datum['funny']),
-                'cool': (datum['cool']),
-            })
-            message = 'ADDING REVIEWS'
-            self.thread_safe_increment(message, thread_idx)
+        try:
+            db.notify_data_loaded(connection)
+        finally:
+            db.release_connection(connection)
 
+    def touch_businesses(self, business_ids):
+        business_ids = set(business_ids)
         with self.lock:
-            db.insert_batch(connection, 'review', review_batch, conflict_columns=['review_id'])
+            self.touched_businesses |= business_ids
 
-        db.release_connection(connection)
-
-    def parse_user_data(self, thread_idx, data, db):
+    def restore_pending_constraints(self, db):
+        # A load killed while its constraints were dropped never got to put them back; do that before anything else.
         connection = db.get_connection()
-        user_batch = []
-        for i in range(len(data)):
-            datum = data[i]
-            user_batch.append({
-                'user_id': self.clean_str_4_sql(datum['user_id']),
-                'name': self.clean_str_4_sql(datum['name']),
-                'yelping_since': self.clean_str_4_sql(datum['yelping_since']),
-                'review_count': datum['review_count'],
-                'fans': datum['fans'],
-                'average_stars': datum['average_stars'],
-                'funny': datum['funny'],
-                'useful': datum['useful'],
-                'cool': datum['cool'],
-            })
-            message = 'ADDING USERS'
-            self.thread_safe_increment(message, thread_idx)
-        with self.lock:
-            db.insert_batch(connection, 'yelp_user', user_batch, conflict_columns=['user_id'])
-
-        if thread_idx == 0:
-            print()
-            print('Parsing friends...')
-            self.iteration = 0
-
-        self.barrier.wait()
-
-        friend_batch = []
-        for i in range(len(data)):
-            datum = data[i]
-            user_id = datum['user_id']
-            for friend in datum['friends']:
-                friend_batch.append({
-                    'fk_user_id': self.clean_str_4_sql(user_id),
-                    'fk_friend_id': self.clean_str_4_sql(friend),
-                })
-
-            message = 'ADDING FRIENDS'
-            self.thread_safe_increment(message, thread_idx)
-
-        with self.lock:
-            db.insert_batch(connection, 'friend', friend_batch, conflict_columns=['fk_friend_id', 'fk_user_id'])
+        try:
+            foreign_keys, indexes = db.pending_load_constraints(connection)
+        finally:
+            db.release_connection(connection)
+        if not foreign_keys and not indexes:
+            return
+        print(f'Restoring {len(foreign_keys)} foreign keys and {len(indexes)} indexes an earlier load dropped...')
+        started = time.perf_counter()
+        timings, failures = db.restore_load_constraints(foreign_keys, indexes, self.num_threads)
+        self.constraint_report(timings, 0.0, time.perf_counter() - started)
+        if failures:
+            for statement, error in failures:
+                print(f'FAILED {statement}: {error}')
+            raise failures[0][1]
+
+    def run_with_constraints_dropped(self, db):
+        connection = db.get_connection()
+        try:
+            foreign_keys, indexes = db.drop_load_constraints(connection, COLUMNS)
+        finally:
+            db.release_connection(connection)
+        print(f'Dropped {len(foreign_keys)} foreign keys and {len(indexes)} indexes for the load')
+        started = time.perf_counter()
+        try:
+            self.run_load(db)
+        finally:
+            # Put them back even after a failed load so the schema is never left without them.
+            load_seconds = time.perf_counter() - started
+            print('\nRebuilding indexes and validating foreign keys...')
+            started = time.perf_counter()
+            timings, failures = db.restore_load_constraints(foreign_keys, indexes, self.num_threads)
+            rebuild_seconds = time.perf_counter() - started
+            self.constraint_report(timings, load_seconds, rebuild_seconds)
+        if failures:
+            for statement, error in failures:
+                print(f'FAILED {statement}: {error}')
+            raise failures[0][1]
+
+    def constraint_report(self, timings, load_seconds, rebuild_seconds):
+        # The rebuild runs in parallel, so its wall time is less than the sum of its statements.
+        for statement, seconds in sorted(timings, key=lambda timing: -timing[1]):
+            print(f'{seconds:>8.2f}s  {statement}')
+        serial_seconds = sum(seconds for _, seconds in timings)
+        print(f'Loaded in {load_seconds:.2f}s, rebuilt in {rebuild_seconds:.2f}s '
+              f'({serial_seconds:.2f}s one at a time, {serial_seconds - rebuild_seconds:.2f}s saved by running them in '
+              f'parallel)')
+
+    def run_bulk_load(self, db):
+        # Every worker turns the triggers off on its own connection, see worker.
+        try:
+            self.run_phases(db)
+        finally:
+            # Even after a failed load, bring the aggregates in line with whatever did get inserted.
+            print('\nRecomputing business stars, review counts and checkins...')
+            connection = db.get_connection()
+            try:
+                db.refresh_business_aggregates(connection)
+            finally:
+                db.release_connection(connection)
+
+    def phase_dependencies(self, phase):
+        if self.parallel_phases:
+            return PHASE_DEPENDENCIES[phase]
+        # Sequential: every phase waits for the one listed before it.
+        order = list(PHASE_DEPENDENCIES)
+        return order[:order.index(phase)][-1:]
+
+    def phase_decoder(self, phase, shared=False):
+        if not self.used_fields_only:
+            return self.decoder
+        # Objects that stay in memory for a later phase reading the same file need that phase's fields too.
+        fields = list(PHASE_FIELDS[phase])
+        if shared:
+            for other in PHASE_FILES:
+                if PHASE_FILES[other] == PHASE_FILES[phase]:
+                    fields += [field for field in PHASE_FIELDS[other] if field not in fields]
+        return Milestone3Decoder(self.decoder.name, fields)
+
+    def phase_rows(self, phase):
+        # build_rows, write_rows and loading bar message of each phase.
+        return {
+            'businesses': (business_rows, self.write_business_rows, 'ADDING BUSINESSES'),
+            'users': (user_rows, self.write_user_rows, 'ADDING USERS'),
+            'friends': (friend_rows, self.write_friend_rows, 'ADDING FRIENDS'),
+            'reviews': (review_rows, self.write_review_rows, 'ADDING REVIEWS'),
+            'checkins': (checkin_rows, self.write_checkin_rows, 'ADDING CHECKINS'),
+        }[phase]
+
+    def run_phase_graph(self, db, executor=None):
+        # Every phase gets a reader thread that waits for the phases it depends on and then feeds its batches into
+        # one shared queue. The same num_threads workers drain it whatever the phases are, so running phases side by
+        # side never needs more connections than the pool has.
+        self.stream_error = None
+        self.reset_progress()
+        self.item_count = 0
+        self.memory_data = {}
+        self.phases = {phase: Phase(phase, self.phase_dependencies(phase)) for phase in PHASE_DEPENDENCIES}
+        self.update_emoticon()
+        self.start_loading_bar()
+        # A bounded queue keeps the readers at most a couple of batches ahead of the workers. With a process pool the
+        # queue holds futures, which also bounds how many parsed batches can pile up.
+        work = queue.Queue(maxsize=2 * self.num_threads)
+        workers = [threading.Thread(target=self.worker, args=(i, work, db)) for i in range(self.num_threads)]
+        readers = [threading.Thread(target=self.read_phase, args=(phase, work, executor))
+                   for phase in self.phases.values()]
+        for thread in workers + readers:
+            thread.start()
 
-        db.release_connection(connection)
+        for thread in readers:
+            thread.join()
+        for _ in workers:
+            work.put(None)
+        for thread in workers:
+            thread.join()
 
-    def parse_checkin_data(self, thread_idx, data, db):
-        connection = db.get_connection()
-        checkin_day_batch = []
-        checkin_hour_batch = []
-        for i in range(len(data)):
-            datum = data[i]
-            business_id = self.clean_str_4_sql(datum['business_id'])
-
-            for day, hours in datum['time'].items():
-                day_of_week = self.clean_str_4_sql(day)
-                checkin_day_batch.append({
-                    'day': day_of_week,
-                    'fk_business_id': business_id,
-                })
-
-            message = 'ADDING CHECKIN DAYS'
-            self.loading_bar(message, thread_idx)
-            self.thread_safe_increment(message, thread_idx)
-
-        if thread_idx == 0:
-            self.iteration = 0
+        self.stop_loading_bar()
+        print()
+        if self.stream_error is not None:
+            raise self.stream_error
+
+    def read_phase(self, phase, work, executor=None):
+        for dependency in phase.dependencies:
+            self.phases[dependency].done.wait()
+        if self.stream_error is not None:
+            return
+        try:
+            phase.started = time.perf_counter()
+            batches = self.phase_batches(phase, executor)
+            if batches is None:
+                phase.done.set()
+                return
+            self.update_progress_message()
+            for batch_id, end_offset, batch in batches:
+                if self.stream_error is not None:
+                    return
+                with self.lock:
+                    phase.pending += 1
+                work.put((phase, batch_id, end_offset, batch))
+                self.metrics.record_queue_depth(work.qsize())
+            with self.lock:
+                phase.read = True
+                finished = phase.pending == 0
+            if finished:
+                self.finish_phase(phase)
+        except Exception as e:
+            self.fail(e)
+
+    def phase_batches(self, phase, executor=None):
+        # Returns the (batch id, end offset, batch) source of a phase, or None if the checkpoint has it loaded already.
+        file_path = self.input_path(PHASE_FILES[phase.name])
+        offset = 0
+        if self.checkpoint is not None:
+            offset = self.checkpoint.begin(phase.name, file_path)
+            if offset is None:
+                print(f'\nSkipping {phase.name}, already loaded.')
+                return None
+        phase.build_rows, phase.write_rows, phase.message = self.phase_rows(phase.name)
+        if phase.name == 'friends' and self.friend_graph:
+            return self.friend_graph_batches(phase, file_path)
+
+        if not self.stream:
+            items = self.memory_items(phase, file_path)
+            self.add_item_count(len(items))
+            # Hand the items out in small work units that idle threads pull as they finish, so a thread that drew the
+            # users with thousands of friends doesn't hold everyone else up.
+            return ((unit_id, None, items[start:start + self.batch_size])
+                    for unit_id, start in enumerate(range(0, len(items), self.batch_size)))
+
+        print(f'\nStreaming {phase.name}...\n')
+        decoder = self.phase_decoder(phase.name)
+        self.add_item_count(self.count_lines(file_path, offset))
+        # Batches carry their id and end offset so the checkpoint knows what has been committed.
+        if executor is not None:
+            return ((batch_id, end_offset, executor.submit(parse_lines, phase.build_rows, lines, decoder))
+                    for batch_id, (end_offset, lines)
+                    in enumerate(self.line_batches(file_path, self.batch_size, offset)))
+        return ((batch_id, end_offset, data)
+                for batch_id, (end_offset, data)
+                in enumerate(self.json_batches(file_path, self.batch_size, offset, decoder)))
+
+    def memory_items(self, phase, file_path):
+        # The user file feeds users and then friends, so it stays in memory until the phase after it takes it.
+        data = self.memory_data.pop(file_path, None)
+        if data is None:
+            data = self.json_to_memory(file_path, phase.name, self.phase_decoder(phase.name, shared=True))
+        if any(PHASE_FILES[other] == PHASE_FILES[phase.name] and phase.name in PHASE_DEPENDENCIES[other]
+               for other in PHASE_FILES):
+            self.memory_data[file_path] = data
+        return data
 
+    def friend_graph_batches(self, phase, file_path):
+        # The graph is rebuilt from the whole file every time, so the checkpoint only records whether it finished.
+        print('\nBuilding friend graph...')
+        graph = Milestone3FriendGraph()
+        if self.stream:
+            decoder = self.phase_decoder(phase.name)
+            users = (datum for _, batch in self.json_batches(file_path, self.batch_size, 0, decoder) for datum in batch)
+        else:
+            users = self.memory_items(phase, file_path)
+        for datum in users:
+            graph.add_user(clean_str_4_sql(datum['user_id']), [clean_str_4_sql(friend) for friend in datum['friends']])
+        edges = graph.unique_edges()
+        print(f'{graph.listed} friends listed, {len(edges)} unique friendships between known users.\n')
+
+        phase.build_rows = graph.edge_rows
+        self.add_item_count(len(edges))
+        return ((unit_id, None, edges[start:start + self.batch_size])
+                for unit_id, start in enumerate(range(0, len(edges), self.batch_size)))
+
+    def add_item_count(self, count):
         with self.lock:
-            db.insert_batch(connection, 'checkin_day', checkin_day_batch, conflict_columns=['fk_business_id', 'day'])
-        checkin_day_batch.clear()
-        self.barrier.wait()
-
-        for i in range(len(data)):
-            datum = data[i]
-            business_id = self.clean_str_4_sql(datum['business_id'])
-            for day, times in datum['time'].items():
-                day = self.clean_str_4_sql(day)
-                checkin_day_id = db.get_checkin_day_fk(connection, day, business_id)
-                for hour, count in times.items():
-                    checkin_hour_batch.append({
-                        'fk_day_id': checkin_day_id,
-                        'total_checkins': count,
-                        'hour': self.clean_str_4_sql(hour)
-                    })
-
-            message = 'ADDING CHECKIN-HOURS'
-            self.thread_safe_increment(message, thread_idx)
+            self.item_count += count
+
+    def finish_phase(self, phase):
+        # A failed load leaves the checkpoint where it is; the phase is only marked done so its dependents wake up.
+        if self.stream_error is None:
+            self.metrics.record_phase(phase.name, time.perf_counter() - phase.started)
+            if self.checkpoint is not None:
+                self.checkpoint.finish(phase.name)
+        phase.done.set()
+        self.update_emoticon()
+        self.update_progress_message()
 
+    def fail(self, error):
         with self.lock:
-            db.insert_batch(connection, 'checkin_hour', checkin_hour_batch, conflict_columns=['time_id'])
-
-        db.release_connection(connection)
+            if self.stream_error is None:
+                self.stream_error = error
+        # Wake up every reader still waiting on a dependency so it can see the error and give up.
+        for phase in self.phases.values():
+            phase.done.set()
+
+    def worker(self, thread_idx, work, db):
+        # A worker that can't set up its connection fails the load but still drains the queue below, so the readers
+        # never block on it.
+        connection = None
+        try:
+            connection = db.get_connection()
+            # Set either way: a pooled connection may still have it from an earlier load.
+            db.set_bulk_load(connection, self.bulk_load)
+        except Exception as e:
+            self.fail(e)
+        try:
+            while True:
+                item = work.get()
+                if item is None:
+                    break
+                phase, batch_id, end_offset, batch = item
+                # After a failure keep draining the queue so the readers never block on a full queue.
+                if self.stream_error is None:
+                    try:
+                        if isinstance(batch, Future):
+                            item_count, parse_seconds, rows = batch.result()
+                            self.metrics.record_parse(thread_idx, parse_seconds)
+                            phase.write_rows(thread_idx, rows, db, connection)
+                            self.metrics.add_items(thread_idx, item_count)
+                        else:
+                            rows = self.build(thread_idx, phase.build_rows, batch)
+                            phase.write_rows(thread_idx, rows, db, connection)
+                        if self.checkpoint is not None and end_offset is not None:
+                            self.checkpoint.commit(phase.name, batch_id, end_offset)
+                    except Exception as e:
+                        self.fail(e)
+                with self.lock:
+                    phase.pending -= 1
+                    finished = phase.read and phase.pending == 0
+                if finished:
+                    self.finish_phase(phase)
+        finally:
+            if connection is not None:
+                try:
+                    if self.bulk_load:
+                        db.set_bulk_load(connection, False)
+                except Exception as e:
+                    self.fail(e)
+                finally:
+                    db.release_connection(connection)
+
+    def resolve_checkin_hours(self, db, connection, checkin_hour_batch):
+        # One lookup for the whole batch rather than a round trip per (business, day).
+        keys = {(fk_business_id, day) for fk_business_id, day, _, _ in checkin_hour_batch}
+        day_ids = db.get_checkin_day_fks(connection, keys)
+        resolved_batch = []
+        for fk_business_id, day, total_checkins, hour in checkin_hour_batch:
+            resolved_batch.append((day_ids.get((fk_business_id, day)), total_checkins, hour))
+        return resolved_batch
+
+    # ---------------------------------- Write Rows -----------------------------------------------------------------
+    # Each batch writes its parent rows before its child rows on the worker's own connection, so no worker ever has to
+    # wait for the others inside a phase.
+    def write_business_rows(self, thread_idx, rows, db, connection):
+        business_batch, category_batch, business_category_batch, business_hours_batch = rows
+        self.insert_rows(db, connection, 'business', business_batch, conflict_columns=['business_id'])
+        self.touch_businesses(row[0] for row in business_batch)
+        self.insert_rows(db, connection, 'categories', category_batch, conflict_columns=['category'])
+        self.insert_rows(db, connection, 'business_categories', business_category_batch,
+                         conflict_columns=['fk_business_id', 'fk_category'])
+        self.insert_rows(db, connection, 'business_hours', business_hours_batch,
+                         conflict_columns=['fk_business_id', 'day_of_week'])
+
+    # Outside a bulk load every review and checkin_hour insert also updates its business row from a trigger. Those
+    # rows are locked in insert order, so reviews and checkins go in sorted by business: every transaction, in either
+    # phase, then locks businesses in the same order and none can deadlock on them.
+    def write_review_rows(self, thread_idx, rows, db, connection):
+        self.insert_rows(db, connection, 'review', rows, conflict_columns=['review_id'],
+                         sort_columns=['fk_business_id', 'review_id'])
+        self.touch_businesses(row[2] for row in rows)
+
+    def write_user_rows(self, thread_idx, rows, db, connection):
+        self.insert_rows(db, connection, 'yelp_user', rows, conflict_columns=['user_id'])
+
+    def write_friend_rows(self, thread_idx, rows, db, connection):
+        self.insert_rows(db, connection, 'friend', rows, conflict_columns=['fk_friend_id', 'fk_user_id'])
+
+    def write_checkin_rows(self, thread_idx, rows, db, connection):
+        checkin_day_batch, checkin_hour_batch = rows
+        self.insert_rows(db, connection, 'checkin_day', checkin_day_batch,
+                         conflict_columns=['fk_business_id', 'day'])
+        self.touch_businesses(row[1] for row in checkin_day_batch)
+        # Sorted by business while the rows still have it; resolving the day ids drops it.
+        checkin_hour_batch = sorted(checkin_hour_batch, key=lambda row: (row[0], row[1], row[3]))
+        checkin_hour_batch = self.resolve_checkin_hours(db, connection, checkin_hour_batch)
+        # Conflicting on (fk_day_id, hour) rather than the serial time_id makes a replayed batch a no-op.
+        self.insert_rows(db, connection, 'checkin_hour', checkin_hour_batch, conflict_columns=['fk_day_id', 'hour'],
+                         sort_columns=[])
 
 
 if __name__ == '__main__':
-    pj = ParseJSON(None)
-    pj.run_threads()
+    # e.g. --copy=friend,checkin_hour
+    copy_tables = [arg[len('--copy='):].split(',') for arg in sys.argv if arg.startswith('--copy=')]
+    # --checkpoint resumes an interrupted load, --delta also picks up lines appended to finished files.
+    checkpoint = None
+    if '--checkpoint' in sys.argv or '--delta' in sys.argv:
+        checkpoint = Milestone3Checkpoint('../yelpInput/ingest_checkpoint.json', delta='--delta' in sys.argv)
+    # --metrics=ingest.prom or --metrics=ingest.json
+    metrics_path = [arg[len('--metrics='):] for arg in sys.argv if arg.startswith('--metrics=')]
+    # --decoder=orjson|simdjson|json, and --used-fields to keep only the keys the loader reads
+    decoder = [arg[len('--decoder='):] for arg in sys.argv if arg.startswith('--decoder=')]
+    pj = ParseJSON(None, stream='--stream' in sys.argv, copy_tables=copy_tables[0] if copy_tables else None,
+                   processes='--processes' in sys.argv, bulk_load='--bulk' in sys.argv, checkpoint=checkpoint,
+                   metrics_path=metrics_path[0] if metrics_path else None, friend_graph='--friend-graph' in sys.argv,
+                   parallel_phases='--sequential' not in sys.argv, decoder=decoder[0] if decoder else None,
+                   used_fields_only='--used-fields' in sys.argv, drop_constraints='--drop-constraints' in sys.argv)
+    # --refresh-summaries only recomputes the stored rankings and zipcode summaries, after writes that didn't go
+    # through the loader.
+    if '--refresh-summaries' in sys.argv:
+        pj.refresh_all()
+    else:
+        pj.run_threads()
@@ -0,0 +1,312 @@
+import json
+import multiprocessing
+import os
+import random
+import resource
+import string
+import sys
+import time
+import tracemalloc
+
+from Kyle_Lim_parseJSON import COLUMNS, PHASE_FIELDS, PHASE_FILES, ParseJSON, friend_rows, review_rows, user_rows
+from Milestone3DB import Milestone3DB
+from Milestone3Decoder import Milestone3Decoder, available_decoders
+from Milestone3SyntheticData import Milestone3SyntheticData
+
+# The benchmark rebuilds its database from the project schema, so never point it at the real milestone3db.
+SCHEMA_FILE = '../Kyle_Lim_hw_files/Kyle_Lim_relations_v2.sql'
+LOADED_TABLES = ['business', 'categories', 'business_categories', 'business_hours', 'yelp_user', 'friend', 'review',
+                 'checkin_day', 'checkin_hour']
+
+
+def run_ingest(results, db_settings, input_dir, num_threads, options):
+    # Runs one load in a fresh process and puts (total seconds, metrics, phase seconds, peak MB, peak MB of the parse
+    # worker processes) or ('error', message) on results. A fresh process's peak memory is the load's alone: it never
+    # held the generated data or an earlier load.
+    try:
+        db = Milestone3DB(**db_settings)
+        db.create_connection_pool(num_threads)
+        pj = ParseJSON(num_threads, input_dir=input_dir, **options)
+        started = time.perf_counter()
+        pj.run_threads(db)
+        total_seconds = time.perf_counter() - started
+        db.connection_pool.closeall()
+        # ru_maxrss is in kilobytes on Linux. Worker processes of the process pool count as children.
+        own_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        children_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        results.put((total_seconds, pj.metrics.to_dict(), dict(pj.metrics.phase_seconds), own_mb, children_mb))
+    except Exception as e:
+        results.put(('error', f'{type(e).__name__}: {e}'))
+
+
+class Milestone3Benchmark:
+    def __init__(self, db):
+        self.db = db
+
+    # ------------------------- Helper Methods ------------------------------------------------------
+    def random_id(self):
+        # Yelp ids are 22 url-safe characters.
+        return ''.join(random.choices(string.ascii_letters + string.digits + '-_', k=22))
+
+    def friend_rows(self, row_count):
+        # Shaped like the friend table: roughly 5 friends per user.
+        user_ids = [self.random_id() for _ in range(max(row_count // 5, 2))]
+        return [{
+            'fk_user_id': random.choice(user_ids),
+            'fk_friend_id': random.choice(user_ids),
+        } for _ in range(row_count)]
+
+    def report(self, name, row_count, seconds):
+        print(f'{name:<14}{row_count:>10} rows {seconds:>8.2f}s {row_count / seconds:>12.0f} rows/sec')
+
+    def load_in_fresh_process(self, input_dir, num_threads, options):
+        # spawn rather than fork, since a forked child starts out with this process's memory.
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        db_settings = {'host': self.db.host, 'dbname': self.db.dbname, 'user': self.db.user,
+                       'password': self.db.password, 'port': self.db.port}
+        process = context.Process(target=run_ingest, args=(results, db_settings, input_dir, num_threads, options))
+        process.start()
+        result = results.get()
+        process.join()
+        if result[0] == 'error':
+            raise RuntimeError(f'Load failed: {result[1]}')
+        return result
+
+    def count_lines(self, file_path):
+        with open(file_path, 'rb') as f:
+            return sum(1 for _ in f)
+
+    def setup_schema(self, zipcodes):
+        connection = self.db.get_connection()
+        try:
+            with open(SCHEMA_FILE, 'r') as f:
+                schema = f.read()
+            with connection.cursor() as cursor:
+                cursor.execute(schema)
+            connection.commit()
+            self.db.insert_batch(connection, 'zipcode', [{
+                'zipcode': zipcode,
+                'mean_income': 50000,
+                'median_income': 45000,
+                'population': 10000,
+            } for zipcode in zipcodes], conflict_columns=['zipcode'])
+        finally:
+            self.db.release_connection(connection)
+
+    def table_counts(self):
+        connection = self.db.get_connection()
+        try:
+            counts = {}
+            with connection.cursor() as cursor:
+                for table in LOADED_TABLES:
+                    cursor.execute(f'select count(*) from {table}')
+                    counts[table] = cursor.fetchone()[0]
+            connection.commit()
+            return counts
+        finally:
+            self.db.release_connection(connection)
+
+    # ------------------------- Benchmarks ------------------------------------------------------
+    def benchmark_copy(self, row_count):
+        # Compare insert_batch with copy_batch on a temp table with the same keys as friend. The foreign keys are
+        # left out so the random ids don't need matching users.
+        connection = self.db.get_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    create temp table if not exists benchmark_friend (
+                        fk_user_id varchar(100) not null,
+                        fk_friend_id varchar(100) not null,
+                        primary key (fk_friend_id, fk_user_id)
+                    )
+                """)
+            connection.commit()
+
+            rows = self.friend_rows(row_count)
+            loaders = [('insert_batch', self.db.insert_batch), ('copy_batch', self.db.copy_batch)]
+            for name, loader in loaders:
+                with connection.cursor() as cursor:
+                    cursor.execute('truncate benchmark_friend')
+                connection.commit()
+
+                start = time.perf_counter()
+                loader(connection, 'benchmark_friend', rows, conflict_columns=['fk_friend_id', 'fk_user_id'])
+                self.report(name, row_count, time.perf_counter() - start)
+        finally:
+            self.db.release_connection(connection)
+
+    def benchmark_ingest(self, scale, input_dir, num_threads, **options):
+        # Generate Yelp-shaped files at the given scale, load them into a fresh schema with ParseJSON and report
+        # per-phase wall time and throughput, total rows/sec and the load's peak memory.
+        data = Milestone3SyntheticData(scale)
+        data.generate(input_dir)
+        self.setup_schema(data.zipcodes)
+        del data
+
+        total_seconds, metrics, phase_seconds, own_mb, children_mb = self.load_in_fresh_process(input_dir, num_threads,
+                                                                                                options)
+        counts = self.table_counts()
+        results = {
+            'scale': scale,
+            'options': {'num_threads': num_threads, **options},
+            'total_seconds': total_seconds,
+            'rows': counts,
+            'rows_per_sec': sum(counts.values()) / total_seconds,
+            'peak_memory_mb': own_mb,
+            'peak_child_memory_mb': children_mb,
+            'phases': {},
+            'metrics': metrics,
+        }
+        for phase, seconds in phase_seconds.items():
+            items = self.count_lines(os.path.join(input_dir, PHASE_FILES[phase]))
+            results['phases'][phase] = {'seconds': seconds, 'items': items, 'items_per_sec': items / seconds}
+        return results
+
+    def benchmark_constraints(self, scale, input_dir, num_threads, **options):
+        # The same load with the foreign keys and indexes in place, then with them dropped and rebuilt afterwards.
+        kept = self.benchmark_ingest(scale, input_dir, num_threads, **options)
+        dropped = self.benchmark_ingest(scale, input_dir, num_threads, drop_constraints=True, **options)
+        print(f"constraints kept {kept['total_seconds']:.2f}s, dropped and rebuilt {dropped['total_seconds']:.2f}s, "
+              f"{kept['total_seconds'] - dropped['total_seconds']:.2f}s saved")
+        return kept, dropped
+
+    def benchmark_memory(self, scale):
+        # Peak memory of building a phase's rows and getting them ready for insert_batch, for dict rows (one dict per
+        # row, flattened to tuples by insert_batch) against the tuple rows the loader builds.
+        data = Milestone3SyntheticData(scale)
+        user_ids = [data.random_id() for _ in range(data.user_count)]
+        business_ids = [data.random_id() for _ in range(data.business_count)]
+        users = list(data.users(user_ids))
+        phases = [
+            ('review', review_rows, list(data.reviews(business_ids, user_ids))),
+            ('yelp_user', user_rows, users),
+            ('friend', friend_rows, users),
+        ]
+        results = {}
+        for table, build_rows, items in phases:
+            columns = COLUMNS[table]
+            tracemalloc.start()
+            rows = [dict(zip(columns, row)) for datum in items for row in build_rows([datum])]
+            self.db.row_tuples(rows, None)
+            dict_peak = tracemalloc.get_traced_memory()[1]
+            del rows
+            tracemalloc.stop()
+
+            tracemalloc.start()
+            rows = build_rows(items)
+            self.db.row_tuples(rows, columns)
+            tuple_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            results[table] = {'rows': len(rows), 'dict_mb': dict_peak / 2 ** 20, 'tuple_mb': tuple_peak / 2 ** 20}
+            print(f'{table:<14}{len(rows):>10} rows  dicts {dict_peak / 2 ** 20:>8.1f} MB  '
+                  f'tuples {tuple_peak / 2 ** 20:>8.1f} MB  {1 - tuple_peak / dict_peak:>5.0%} less')
+            del rows
+        return results
+
+    def benchmark_decoders(self, input_dir, phases=('reviews', 'users')):
+        # Decode every line of the review and user files with each installed decoder, keeping all fields and then only
+        # the fields the loader reads.
+        results = {}
+        for phase in phases:
+            with open(os.path.join(input_dir, PHASE_FILES[phase]), 'rb') as f:
+                lines = f.readlines()
+            megabytes = sum(len(line) for line in lines) / 2 ** 20
+            for name in available_decoders():
+                for fields in [None, PHASE_FIELDS[phase]]:
+                    decoder = Milestone3Decoder(name, fields)
+                    started = time.perf_counter()
+                    for line in lines:
+                        decoder.decode(line)
+                    seconds = time.perf_counter() - started
+                    label = name + (' used fields' if fields is not None else '')
+                    results[f'{phase} {label}'] = {'lines': len(lines), 'seconds': seconds,
+                                                   'lines_per_sec': len(lines) / seconds}
+                    print(f'{phase:<10}{label:<22}{len(lines):>10} lines {seconds:>8.2f}s '
+                          f'{len(lines) / seconds:>12.0f} lines/sec {megabytes / seconds:>8.1f} MB/s')
+        return results
+
+    def print_results(self, results):
+        print()
+        for phase, result in results['phases'].items():
+            print(f"{phase:<12}{result['items']:>10} items {result['seconds']:>8.2f}s "
+                  f"{result['items_per_sec']:>12.0f} items/sec")
+        print(f"{'total':<12}{sum(results['rows'].values()):>10} rows  {results['total_seconds']:>8.2f}s "
+              f"{results['rows_per_sec']:>12.0f} rows/sec")
+        print(f"peak memory {results['peak_memory_mb']:.0f} MB "
+              f"(worker processes {results['peak_child_memory_mb']:.0f} MB)")
+
+    def compare(self, results, baseline, tolerance=0.2):
+        # A phase regresses when its throughput drops more than tolerance below the baseline run.
+        regressions = []
+        for phase, result in results['phases'].items():
+            if phase not in baseline['phases']:
+                continue
+            expected = baseline['phases'][phase]['items_per_sec']
+            if result['items_per_sec'] < expected * (1 - tolerance):
+                regressions.append(phase)
+                print(f"REGRESSION {phase}: {result['items_per_sec']:.0f} items/sec, baseline {expected:.0f}")
+        return regressions
+
+
+def option(name, default=None):
+    # Command line options look like --name=value.
+    for arg in sys.argv:
+        if arg.startswith(f'--{name}='):
+            return arg[len(name) + 3:]
+    return default
+
+
+if __name__ == '__main__':
+    # python Milestone3Benchmark.py copy [rows]
+    # python Milestone3Benchmark.py memory [scale]
+    # python Milestone3Benchmark.py decode [scale] [--input=../yelpInput]
+    # python Milestone3Benchmark.py constraints [scale] takes the ingest options and loads once with the constraints
+    #     in place and once with them dropped and rebuilt
+    # python Milestone3Benchmark.py ingest [scale] [--stream] [--processes] [--bulk] [--sequential]
+    #     [--copy=friend,checkin_hour] [--decoder=orjson] [--used-fields] [--drop-constraints]
+    #     [--threads=N] [--save=results.json] [--baseline=results.json] [--dbname=milestone3bench]
+    command = sys.argv[1] if len(sys.argv) > 1 else 'copy'
+    positional = [arg for arg in sys.argv[2:] if not arg.startswith('--')]
+    db = Milestone3DB('localhost', option('dbname', 'milestone3bench'), 'postgres', '', 5432)
+    if command == 'copy':
+        db.create_connection_pool(1)
+        Milestone3Benchmark(db).benchmark_copy(int(positional[0]) if positional else 100000)
+    elif command == 'memory':
+        Milestone3Benchmark(db).benchmark_memory(float(positional[0]) if positional else 0.01)
+    elif command == 'decode':
+        # Synthetic files unless --input points at real ones.
+        input_dir = option('input')
+        if input_dir is None:
+            input_dir = '../benchInput'
+            Milestone3SyntheticData(float(positional[0]) if positional else 0.01).generate(input_dir)
+        Milestone3Benchmark(db).benchmark_decoders(input_dir)
+    elif command in ('ingest', 'constraints'):
+        num_threads = int(option('threads', 4))
+        db.create_connection_pool(num_threads)
+        benchmark = Milestone3Benchmark(db)
+        copy_tables = option('copy')
+        scale = float(positional[0]) if positional else 0.01
+        options = {
+            'stream': '--stream' in sys.argv,
+            'processes': '--processes' in sys.argv,
+            'bulk_load': '--bulk' in sys.argv,
+            'parallel_phases': '--sequential' not in sys.argv,
+            'decoder': option('decoder'),
+            'used_fields_only': '--used-fields' in sys.argv,
+            'copy_tables': copy_tables.split(',') if copy_tables else None,
+        }
+        if command == 'constraints':
+            benchmark.benchmark_constraints(scale, '../benchInput', num_threads, **options)
+            sys.exit(0)
+        results = benchmark.benchmark_ingest(scale, '../benchInput', num_threads,
+                                             drop_constraints='--drop-constraints' in sys.argv, **options)
+        benchmark.print_results(results)
+        if option('save') is not None:
+            with open(option('save'), 'w') as f:
+                json.dump(results, f, indent=2)
+        if option('baseline') is not None:
+            with open(option('baseline'), 'r') as f:
+                if benchmark.compare(results, json.load(f)):
+                    sys.exit(1)
@@ -0,0 +1,68 @@
+import json
+import os
+import threading
+
+
+class Milestone3Checkpoint:
+    # Manifest of how far each loader phase got, keyed by phase name ('businesses', 'users', 'friends', ...) since the
+    # user file feeds two phases. For every phase it stores the input file, the byte offset up to which every batch has
+    # been committed, how many batches that is, and whether the phase ran to the end of the file.
+    def __init__(self, path, delta=False):
+        self.path = path
+        # In delta mode finished phases are re-opened at their saved offset so lines appended since the last run are
+        # loaded. Otherwise a finished phase is skipped.
+        self.delta = delta
+        self.lock = threading.Lock()
+        self.phases = {}
+        # Per phase, since phases run side by side: committed batches past the watermark, and the batch it waits on.
+        self.pending = {}
+        self.next_batch = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.phases = json.load(f)
+
+    def save(self):
+        # Write a temp file and swap it in so a crash never leaves a half-written manifest behind.
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.phases, f, indent=2)
+        os.replace(temp_path, self.path)
+
+    def begin(self, phase, file_path):
+        # Returns the byte offset to start reading at, or None if the phase has nothing left to do.
+        with self.lock:
+            self.pending[phase] = {}
+            self.next_batch[phase] = 0
+            state = self.phases.get(phase)
+            if state is None or state['file'] != file_path or os.path.getsize(file_path) < state['offset']:
+                # First run, or the file was replaced or truncated, so its old offsets mean nothing.
+                state = {'file': file_path, 'offset': 0, 'batches': 0, 'complete': False}
+                self.phases[phase] = state
+                self.save()
+            elif state['complete'] and not self.delta:
+                return None
+            elif state['complete']:
+                # Until this delta run finishes, a plain rerun should resume it rather than skip it.
+                state['complete'] = False
+                self.save()
+            return state['offset']
+
+    def commit(self, phase, batch_id, end_offset):
+        # Batches finish out of order across threads, so the saved offset only moves past a batch once every batch
+        # before it has been committed too. A crash can only lose batches after that point, which get replayed. Some of
+        # those may have been written already, in part or in full, so every table the loader writes has to conflict on
+        # a natural key (checkin_hour on unique (fk_day_id, hour)) for a replay to leave no duplicates.
+        with self.lock:
+            pending = self.pending[phase]
+            pending[batch_id] = end_offset
+            state = self.phases[phase]
+            while self.next_batch[phase] in pending:
+                state['offset'] = pending.pop(self.next_batch[phase])
+                state['batches'] += 1
+                self.next_batch[phase] += 1
+            self.save()
+
+    def finish(self, phase):
+        with self.lock:
+            self.phases[phase]['complete'] = True
+            self.save()
@@ -1,18 +1,42 @@
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import psycopg2
 from psycopg2 import sql, pool, extras
 
+# The loader NOTIFYs this channel after every load so the GUI can drop its cached query results.
+DATA_LOADED_CHANNEL = 'milestone3_data_loaded'
+
 
 class Milestone3DB:
-    def __init__(self, host, dbname, user, password, port=5432):
+    def __init__(self, host, dbname, user, password, port=5432, batch_size=1000, page_size=100, adaptive=True,
+                 target_batch_seconds=0.5):
         self.host = host
         self.dbname = dbname
         self.user = user
         self.password = password
         self.port = port
         self.connection_pool = None
+        # insert_batch and copy_batch commit every batch_size rows, and a retry only replays the failed batch.
+        # page_size is how many rows execute_values puts in one statement.
+        self.batch_size = batch_size
+        self.page_size = page_size
+        # When adaptive, each table's batch size halves when a batch takes longer than target_batch_seconds and
+        # doubles when it takes less than half of it.
+        self.adaptive = adaptive
+        self.target_batch_seconds = target_batch_seconds
+        self.min_batch_size = 100
+        self.max_batch_size = 50000
+        self.batch_sizes = {}
+        self.batch_size_lock = threading.Lock()
+        # Set by ParseJSON to a Milestone3Metrics to record insert latency and retries.
+        self.metrics = None
 
     def create_connection_pool(self, num_threads):
-        self.connection_pool = psycopg2.pool.SimpleConnectionPool(
+        # The loader threads share this pool, and SimpleConnectionPool isn't safe to use from several threads.
+        self.connection_pool = psycopg2.pool.ThreadedConnectionPool(
             minconn=1,
             maxconn=num_threads,
             host=self.host,
@@ -32,6 +56,268 @@ class Milestone3DB:
         if self.connection_pool:
             self.connection_pool.putconn(connection)
 
+    def set_bulk_load(self, connection, enabled):
+        # The update_stars/update_num_checkins triggers from Kyle_Lim_UPDATE.sql update a business row for every review
+        # and checkin_hour insert, unless the session has milestone3.bulk_load on. A bulk load turns it on for its own
+        # connections and calls refresh_business_aggregates at the end instead; other sessions keep their triggers,
+        # and a killed loader takes the setting with it when its sessions end.
+        with connection.cursor() as cursor:
+            cursor.execute("select set_config('milestone3.bulk_load', %s, false)", ('on' if enabled else 'off',))
+        connection.commit()
+
+    def refresh_business_aggregates(self, connection):
+        # Set-based equivalent of the triggers: recompute every business from the review and checkin tables.
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                update business b
+                set total_stars = coalesce(r.total_stars, 0),
+                    review_count = coalesce(r.review_count, 0),
+                    stars = coalesce(round(cast(r.total_stars as numeric) / cast(r.review_count as numeric), 1), 0)
+                from business b2
+                left join (
+                    select fk_business_id, sum(stars) as total_stars, count(*) as review_count
+                    from review
+                    group by fk_business_id
+                ) r on r.fk_business_id = b2.business_id
+                where b.business_id = b2.business_id
+            """)
+            cursor.execute("""
+                update business b
+                set num_checkins = coalesce(c.num_checkins, 0)
+                from business b2
+                left join (
+                    select cd.fk_business_id, sum(ch.total_checkins) as num_checkins
+                    from checkin_hour ch
+                    inner join checkin_day cd on cd.day_id = ch.fk_day_id
+                    group by cd.fk_business_id
+                ) c on c.fk_business_id = b2.business_id
+                where b.business_id = b2.business_id
+            """)
+        connection.commit()
+
+    def notify_data_loaded(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute(sql.SQL('notify {}').format(sql.Identifier(DATA_LOADED_CHANNEL)))
+        connection.commit()
+
+    def refresh_zipcode_rankings(self, connection, business_ids=None):
+        # Recompute zipcode_popular and zipcode_successful for the zipcodes of the given businesses, or for every
+        # zipcode when business_ids is None. Rankings are per zipcode, so no other zipcode can change.
+        if business_ids is None:
+            where_str = ''
+            params = ()
+        else:
+            where_str = 'where fk_zipcode in (select fk_zipcode from business where business_id = any(%s))'
+            params = (list(business_ids),)
+        with connection.cursor() as cursor:
+            cursor.execute(f'delete from zipcode_popular {where_str}', params)
+            cursor.execute(f"""
+                insert into zipcode_popular (fk_zipcode, rank, business_id, name, stars, review_count, num_checkins)
+                select fk_zipcode, rn, business_id, name, stars, review_count, num_checkins
+                from (
+                    select
+                        fk_zipcode, business_id, name, stars, review_count, num_checkins,
+                        row_number() over (partition by fk_zipcode order by num_checkins desc, business_id) as rn
+                    from business
+                    {where_str}
+                ) ranked
+                where rn <= 10
+            """, params)
+            cursor.execute(f'delete from zipcode_successful {where_str}', params)
+            cursor.execute(f"""
+                insert into zipcode_successful (fk_zipcode, business_id, name, stars, review_count)
+                select fk_zipcode, business_id, name, stars, review_count
+                from (
+                    select
+                        fk_zipcode, business_id, name, stars, review_count,
+                        row_number() over (partition by fk_zipcode order by num_checkins desc, business_id) as rn,
+                        count(*) over (partition by fk_zipcode) as business_count
+                    from business
+                    {where_str}
+                ) ranked
+                where rn <= (business_count + 1) / 2 and stars >= 4.0
+            """, params)
+        connection.commit()
+
+    def refresh_zipcode_summaries(self, connection, business_ids=None):
+        # Recompute zipcode_summary and zipcode_category_summary for the zipcodes of the given businesses, or for
+        # every zipcode when business_ids is None, in one transaction so the GUI never sees a zipcode half done.
+        if business_ids is None:
+            where_str = ''
+            params = ()
+        else:
+            where_str = 'where fk_zipcode in (select fk_zipcode from business where business_id = any(%s))'
+            params = (list(business_ids),)
+        with connection.cursor() as cursor:
+            cursor.execute(f'delete from zipcode_summary {where_str}', params)
+            cursor.execute(f"""
+                insert into zipcode_summary (fk_zipcode, median_income, population, business_count, total_checkins,
+                                             total_reviews, average_stars)
+                select
+                    b.fk_zipcode, z.median_income, z.population, count(*), coalesce(sum(b.num_checkins), 0),
+                    coalesce(sum(b.review_count), 0), round(avg(b.stars), 2)
+                from business b
+                left join zipcode z on z.zipcode = b.fk_zipcode
+                {where_str}
+                group by b.fk_zipcode, z.median_income, z.population
+            """, params)
+            cursor.execute(f'delete from zipcode_category_summary {where_str}', params)
+            cursor.execute(f"""
+                insert into zipcode_category_summary (fk_zipcode, state, city, fk_category, business_count)
+                select b.fk_zipcode, b.state, b.city, bc.fk_category, count(*)
+                from business b
+                inner join business_categories bc on b.business_id = bc.fk_business_id
+                {where_str}
+                group by b.fk_zipcode, b.state, b.city, bc.fk_category
+            """, params)
+        connection.commit()
+
+    def load_constraints(self, connection, tables):
+        # Foreign keys of the given tables and their indexes that no constraint owns, as (table, name, definition).
+        # Primary keys and unique constraints are left alone because ON CONFLICT needs them while loading.
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                select cl.relname, con.conname, pg_get_constraintdef(con.oid)
+                from pg_constraint con
+                inner join pg_class cl on cl.oid = con.conrelid
+                where con.contype = 'f' and cl.relname = any(%s) and pg_table_is_visible(cl.oid)
+                order by cl.relname, con.conname
+            """, (list(tables),))
+            foreign_keys = cursor.fetchall()
+            cursor.execute("""
+                select t.relname, i.relname, pg_get_indexdef(i.oid)
+                from pg_index x
+                inner join pg_class i on i.oid = x.indexrelid
+                inner join pg_class t on t.oid = x.indrelid
+                where t.relname = any(%s) and pg_table_is_visible(t.oid)
+                and not exists (
+                    select 1 from pg_constraint con
+                    where con.conrelid = x.indrelid and con.conindid = x.indexrelid and con.contype in ('p', 'u', 'x')
+                )
+                order by t.relname, i.relname
+            """, (list(tables),))
+            indexes = cursor.fetchall()
+        connection.commit()
+        return foreign_keys, indexes
+
+    def create_constraint_log(self, cursor):
+        # What drop_load_constraints dropped and restore_load_constraints hasn't put back yet. It lives in the database
+        # and is written in the same transaction as the drops, so a loader killed mid-load leaves a record of exactly
+        # what is missing; pending_load_constraints reads it back on the next run.
+        cursor.execute("""
+            create table if not exists load_dropped_constraints (
+                kind varchar(11) not null,
+                table_name varchar(100) not null,
+                name varchar(100) not null,
+                definition text not null,
+                primary key (table_name, name)
+            )
+        """)
+
+    def drop_load_constraints(self, connection, tables):
+        # Returns what was dropped so restore_load_constraints can put it back.
+        foreign_keys, indexes = self.load_constraints(connection, tables)
+        with connection.cursor() as cursor:
+            self.create_constraint_log(cursor)
+            rows = [('foreign key', table, name, definition) for table, name, definition in foreign_keys]
+            rows += [('index', table, name, definition) for table, name, definition in indexes]
+            if rows:
+                psycopg2.extras.execute_values(cursor, """
+                    insert into load_dropped_constraints (kind, table_name, name, definition) values %s
+                    on conflict (table_name, name) do update set kind = excluded.kind, definition = excluded.definition
+                """, rows)
+            for table, name, _ in foreign_keys:
+                cursor.execute(sql.SQL('alter table {table} drop constraint {name}').format(
+                    table=sql.Identifier(table), name=sql.Identifier(name)))
+            for _, name, _ in indexes:
+                cursor.execute(sql.SQL('drop index {name}').format(name=sql.Identifier(name)))
+        connection.commit()
+        return foreign_keys, indexes
+
+    def pending_load_constraints(self, connection):
+        # The foreign keys and indexes a killed load dropped and never restored, as (table, name, definition) like
+        # drop_load_constraints returns. Entries that exist again (someone put them back by hand) are forgotten.
+        with connection.cursor() as cursor:
+            cursor.execute("select to_regclass('load_dropped_constraints') is not null")
+            if not cursor.fetchone()[0]:
+                connection.commit()
+                return [], []
+            cursor.execute("""
+                delete from load_dropped_constraints d
+                where (kind = 'index' and to_regclass(quote_ident(d.name)) is not null)
+                or (kind = 'foreign key' and exists (
+                    select 1 from pg_constraint con
+                    where con.conname = d.name and con.conrelid = to_regclass(quote_ident(d.table_name))
+                ))
+            """)
+            cursor.execute("""
+                select kind, table_name, name, definition from load_dropped_constraints
+                order by table_name, name
+            """)
+            rows = cursor.fetchall()
+        connection.commit()
+        foreign_keys = [(table, name, definition) for kind, table, name, definition in rows if kind == 'foreign key']
+        indexes = [(table, name, definition) for kind, table, name, definition in rows if kind == 'index']
+        return foreign_keys, indexes
+
+    def forget_load_constraints(self, cursor, entries):
+        for table, name, _ in entries:
+            cursor.execute('delete from load_dropped_constraints where table_name = %s and name = %s', (table, name))
+
+    def restore_load_constraints(self, foreign_keys, indexes, num_threads):
+        # Adding a foreign key as NOT VALID is instant, so they all go back first and are enforced for new rows from
+        # then on. Validating them and building the indexes are the slow scans, and those run on num_threads pooled
+        # connections at once. Returns (statement, seconds) per task and the foreign keys that failed to validate,
+        # which stay NOT VALID.
+        connection = self.get_connection()
+        try:
+            with connection.cursor() as cursor:
+                for table, name, definition in foreign_keys:
+                    cursor.execute(sql.SQL('alter table {table} add constraint {name} {definition} not valid').format(
+                        table=sql.Identifier(table), name=sql.Identifier(name), definition=sql.SQL(definition)))
+                # Back, if only NOT VALID, so they leave the log with the same commit.
+                self.create_constraint_log(cursor)
+                self.forget_load_constraints(cursor, foreign_keys)
+            connection.commit()
+        finally:
+            self.release_connection(connection)
+
+        statements = [definition for _, _, definition in indexes]
+        statements += [sql.SQL('alter table {table} validate constraint {name}').format(
+            table=sql.Identifier(table), name=sql.Identifier(name)) for table, name, _ in foreign_keys]
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            results = list(executor.map(self.run_timed, statements))
+        timings = [(statement, seconds) for statement, seconds, error in results]
+        failures = [(statement, error) for statement, seconds, error in results if error is not None]
+
+        # An index that failed to build stays in the log, so the next run tries it again.
+        built = [index for index, (_, _, error) in zip(indexes, results) if error is None]
+        connection = self.get_connection()
+        try:
+            with connection.cursor() as cursor:
+                self.forget_load_constraints(cursor, built)
+            connection.commit()
+        finally:
+            self.release_connection(connection)
+        return timings, failures
+
+    def run_timed(self, statement):
+        connection = self.get_connection()
+        try:
+            started = time.perf_counter()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(statement)
+                connection.commit()
+                error = None
+            except psycopg2.DatabaseError as e:
+                connection.rollback()
+                error = e
+            label = statement if isinstance(statement, str) else statement.as_string(connection)
+            return label, time.perf_counter() - started, error
+        finally:
+            self.release_connection(connection)
+
     def get_checkin_day_fk(self, connection, day, fk_business_id):
         with connection.cursor() as cursor:
             cursor.execute("""
@@ -43,6 +329,22 @@ class Milestone3DB:
                 return result[0]
             return None
 
+    def get_checkin_day_fks(self, connection, keys):
+        # Look up the day_id of many (fk_business_id, day) pairs in one query instead of one select per pair.
+        keys = list(keys)
+        if not keys:
+            return {}
+        business_ids = [key[0] for key in keys]
+        days = [key[1] for key in keys]
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                select cd.fk_business_id, cd.day, cd.day_id
+                from checkin_day cd
+                inner join unnest(%s::varchar[], %s::varchar[]) as k(fk_business_id, day)
+                on cd.fk_business_id = k.fk_business_id and cd.day = k.day
+            """, (business_ids, days))
+            return {(fk_business_id, day): day_id for fk_business_id, day, day_id in cursor.fetchall()}
+
     def insert_into_table(self, connection, table, data):
         columns = data.keys()
         values = [data[column] for column in columns]
@@ -79,9 +381,13 @@ class Milestone3DB:
         with connection.cursor() as cursor:
             cursor.execute(insert_statement, values)
 
-    def insert_batch(self, connection, table, data_list, conflict_columns=None, max_retries=3):
-        columns = data_list[0].keys()
-        flattened_values = [tuple([d[key] for key in columns]) for d in data_list]
+    def insert_batch(self, connection, table, data_list, conflict_columns=None, max_retries=3, columns=None,
+                     sort_columns=None):
+        # A thread's chunk or a streamed batch can come out empty (e.g. businesses without hours).
+        if not data_list:
+            return
+        columns, data_list = self.row_tuples(data_list, columns)
+        data_list = self.sort_rows(data_list, columns, conflict_columns, sort_columns)
 
         columns_str = ', '.join(columns)
         values_template = ', '.join(['%s'] * len(columns))
@@ -99,21 +405,130 @@ class Milestone3DB:
                 insert into {table} ({columns_str}) values %s
             """
 
+        def execute(batch):
+            with connection.cursor() as cursor:
+                psycopg2.extras.execute_values(cursor, insert_query, batch, template=None, page_size=self.page_size)
+
+        self.run_in_batches(connection, table, data_list, execute, max_retries)
+
+    def copy_batch(self, connection, table, data_list, conflict_columns=None, max_retries=3, columns=None,
+                   sort_columns=None):
+        # COPY can't skip conflicting rows, so the rows go into a staging table first and are merged with the same
+        # ON CONFLICT DO NOTHING as insert_batch. The staging table is a temp table: it is unlogged like any temp
+        # table and private to this connection, so the worker threads never see each other's rows.
+        if not data_list:
+            return
+        columns, data_list = self.row_tuples(data_list, columns)
+        columns_str = ', '.join(columns)
+        staging = f'{table}_staging'
+        data_list = self.sort_rows(data_list, columns, conflict_columns, sort_columns)
+
+        if conflict_columns:
+            # The merge keeps the order the rows were sorted in: by the sort columns, or the order they were copied.
+            order_columns = conflict_columns if sort_columns is None else sort_columns
+            order_str = ', '.join([col for col in order_columns if col in columns])
+            order_str = f'order by {order_str}' if order_str else ''
+            merge_query = f"""
+                insert into {table} ({columns_str}) select {columns_str} from {staging}
+                {order_str}
+                on conflict ({', '.join(conflict_columns)})
+                do nothing
+            """
+        else:
+            merge_query = f"""
+                insert into {table} ({columns_str}) select {columns_str} from {staging}
+            """
+
+        def execute(batch):
+            buffer = io.StringIO()
+            for row in batch:
+                buffer.write('\t'.join([self.copy_value(value) for value in row]))
+                buffer.write('\n')
+            buffer.seek(0)
+            with connection.cursor() as cursor:
+                cursor.execute(f'create temp table if not exists {staging} as '
+                               f'select {columns_str} from {table} with no data')
+                cursor.copy_expert(f'copy {staging} ({columns_str}) from stdin', buffer)
+                cursor.execute(merge_query)
+                cursor.execute(f'truncate {staging}')
+
+        self.run_in_batches(connection, table, data_list, execute, max_retries)
+
+    def row_tuples(self, data_list, columns):
+        # Rows are tuples in the order of columns. Without a column list they are dicts, which get turned into tuples
+        # once here so everything after this works the same way.
+        if columns is not None:
+            return list(columns), data_list
+        columns = list(data_list[0].keys())
+        return columns, [tuple([d[key] for key in columns]) for d in data_list]
+
+    def sort_rows(self, data_list, columns, conflict_columns, sort_columns=None):
+        # Writers run in parallel, so two transactions can insert the same key (e.g. a shared category). Taking the
+        # keys in the same order everywhere means one waits on the other instead of both deadlocking. Rows are sorted
+        # by the conflict columns unless sort_columns says otherwise; an empty sort_columns keeps the order given, for
+        # callers that already sorted by something that isn't a column (see ParseJSON.write_checkin_rows).
+        if sort_columns is not None:
+            conflict_columns = sort_columns
+        if not conflict_columns:
+            return data_list
+        key_indexes = [columns.index(col) for col in conflict_columns if col in columns]
+        if not key_indexes:
+            return data_list
+        return sorted(data_list, key=lambda row: tuple([row[i] for i in key_indexes]))
+
+    def get_batch_size(self, table):
+        with self.batch_size_lock:
+            return self.batch_sizes.get(table, self.batch_size)
+
+    def tune_batch_size(self, table, row_count, seconds):
+        if not self.adaptive:
+            return
+        with self.batch_size_lock:
+            batch_size = self.batch_sizes.get(table, self.batch_size)
+            if seconds > self.target_batch_seconds:
+                batch_size = max(batch_size // 2, self.min_batch_size)
+            elif seconds < self.target_batch_seconds / 2 and row_count >= batch_size:
+                # Only a full batch says anything about whether a bigger one would still be fast.
+                batch_size = min(batch_size * 2, self.max_batch_size)
+            self.batch_sizes[table] = batch_size
+
+    def run_in_batches(self, connection, table, data_list, execute, max_retries=3):
+        start = 0
+        while start < len(data_list):
+            batch = data_list[start:start + self.get_batch_size(table)]
+            began = time.perf_counter()
+            self.run_with_retries(connection, lambda: execute(batch), max_retries, table)
+            seconds = time.perf_counter() - began
+            self.tune_batch_size(table, len(batch), seconds)
+            if self.metrics is not None:
+                self.metrics.record_insert(table, len(batch), seconds)
+            start += len(batch)
+
+    def copy_value(self, value):
+        # Text format COPY: \N is null, and backslash, tab and newlines have to be escaped.
+        if value is None:
+            return '\\N'
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    def run_with_retries(self, connection, execute, max_retries=3, table=None):
         attempt = 0
         while attempt < max_retries:
             try:
-                with connection.cursor() as cursor:
-                    psycopg2.extras.execute_values(cursor, insert_query, flattened_values, template=None, page_size=100)
+                execute()
                 connection.commit()
                 break
             except psycopg2.errors.DeadlockDetected as e:
                 print(f"Deadlock detected: {e}, retrying {attempt + 1}/{max_retries}")
                 connection.rollback()
+                if self.metrics is not None:
+                    self.metrics.record_retry(table, 'deadlock')
                 attempt += 1
                 if attempt == max_retries:
                     raise e
             except psycopg2.DatabaseError as e:
                 connection.rollback()
+                if self.metrics is not None:
+                    self.metrics.record_retry(table, 'error')
                 attempt += 1
                 if attempt == max_retries:
                     raise e
@@ -0,0 +1,74 @@
+import json
+import threading
+
+# orjson and pysimdjson are optional. Without either the loader decodes with the stdlib json module.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+
+def available_decoders():
+    # Fastest first, so the first entry is the default.
+    names = []
+    if orjson is not None:
+        names.append('orjson')
+    if simdjson is not None:
+        names.append('simdjson')
+    names.append('json')
+    return names
+
+
+class Milestone3Decoder:
+    # Decodes one line of a Yelp file. With fields set, only those keys of each object are kept, which stops the
+    # long attribute and compliment dicts the loader never reads from sitting in memory.
+    def __init__(self, name=None, fields=None):
+        decoders = available_decoders()
+        if name is None:
+            name = decoders[0]
+        elif name not in decoders:
+            print(f'JSON decoder {name} is not installed, using {decoders[0]}')
+            name = decoders[0]
+        self.name = name
+        self.fields = list(fields) if fields is not None else None
+        self.local = threading.local()
+
+    # Only the name and fields are pickled, so a decoder can be sent to the process pool along with its lines.
+    def __getstate__(self):
+        return {'name': self.name, 'fields': self.fields}
+
+    def __setstate__(self, state):
+        self.name = state['name']
+        self.fields = state['fields']
+        self.local = threading.local()
+
+    def decode(self, line):
+        if self.name == 'simdjson':
+            return self.decode_simdjson(line)
+        datum = orjson.loads(line) if self.name == 'orjson' else json.loads(line)
+        if self.fields is None:
+            return datum
+        return {field: datum[field] for field in self.fields if field in datum}
+
+    def decode_simdjson(self, line):
+        # simdjson parses lazily, so with fields set the other values are never turned into Python objects at all. A
+        # parser's document is only valid until its next parse, so every thread gets its own parser and nothing from
+        # the document is kept.
+        parser = getattr(self.local, 'parser', None)
+        if parser is None:
+            parser = self.local.parser = simdjson.Parser()
+        document = parser.parse(line)
+        if self.fields is None:
+            return document.as_dict()
+        return {field: self.to_python(document[field]) for field in self.fields if field in document}
+
+    def to_python(self, value):
+        if isinstance(value, simdjson.Object):
+            return value.as_dict()
+        if isinstance(value, simdjson.Array):
+            return value.as_list()
+        return value
@@ -0,0 +1,88 @@
+import json
+import sys
+
+import psycopg2
+
+from psycopg2 import sql
+
+from Milestone3Queries import QUERIES, QUERY_PARAMS
+from Milestone3QueryRegistry import Milestone3QueryRegistry
+
+# Tables the GUI queries filter. A sequential scan of any of them means a click reads the whole table.
+CHECKED_TABLES = ['business', 'business_categories', 'review', 'zipcode', 'zipcode_popular', 'zipcode_successful',
+                  'zipcode_summary', 'zipcode_category_summary']
+
+
+class Milestone3Explain:
+    def __init__(self, conn):
+        self.conn = conn
+        # The GUI runs its queries as prepared statements, so their plans are checked the same way.
+        self.registry = Milestone3QueryRegistry()
+
+    def sample_selection(self):
+        # A state, city, zipcode, category and business that go together, to fill in the query parameters.
+        with self.conn.cursor() as cursor:
+            cursor.execute("""
+                select b.state, b.city, b.fk_zipcode, bc.fk_category, b.name, b.business_id
+                from business b
+                inner join business_categories bc on b.business_id = bc.fk_business_id
+                limit 1
+            """)
+            state, city, zipcode, category, name, business_id = cursor.fetchone()
+        return {'state': state, 'city': city, 'zipcode': zipcode, 'category': category, 'name': name,
+                'business_id': business_id, 'search': 'food'}
+
+    def plan_scans(self, plan, scans=None):
+        # (node type, table, index) of every scan in an EXPLAIN (format json) plan tree.
+        if scans is None:
+            scans = []
+        if 'Relation Name' in plan:
+            scans.append((plan['Node Type'], plan['Relation Name'], plan.get('Index Name')))
+        for child in plan.get('Plans', []):
+            self.plan_scans(child, scans)
+        return scans
+
+    def explain(self, name, selection):
+        params = tuple([selection[param] for param in QUERY_PARAMS[name]])
+        self.registry.prepare(self.conn, name)
+        with self.conn.cursor() as cursor:
+            cursor.execute(sql.SQL('explain (format json) ') + self.registry.statement(name), params)
+            result = cursor.fetchone()[0]
+        if isinstance(result, str):
+            result = json.loads(result)
+        return self.plan_scans(result[0]['Plan'])
+
+    def check(self):
+        # On a small database the planner picks sequential scans no matter what, so they are switched off here: a
+        # query that still gets one has no index it can use. Returns the names of the queries that failed.
+        selection = self.sample_selection()
+        failures = []
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute('set enable_seqscan = off')
+            for name in QUERIES:
+                scans = self.explain(name, selection)
+                seq_scans = sorted({table for node, table, _ in scans
+                                    if node == 'Seq Scan' and table in CHECKED_TABLES})
+                indexes = sorted({index for _, _, index in scans if index is not None})
+                if seq_scans:
+                    failures.append(name)
+                    print(f'FAIL {name:<24} sequential scan of {", ".join(seq_scans)}')
+                else:
+                    print(f'ok   {name:<24} {", ".join(indexes)}')
+        finally:
+            # Rolling back also undoes the set.
+            self.conn.rollback()
+        return failures
+
+
+if __name__ == '__main__':
+    # python Milestone3Explain.py [--dbname=milestone3db]
+    dbname = [arg[len('--dbname='):] for arg in sys.argv if arg.startswith('--dbname=')]
+    conn = psycopg2.connect(host='localhost', dbname=dbname[0] if dbname else 'milestone3db', user='postgres',
+                            password='', port=5432)
+    try:
+        if Milestone3Explain(conn).check():
+            sys.exit(1)
+    finally:
+        conn.close()
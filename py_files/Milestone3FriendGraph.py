@@ -0,0 +1,74 @@
+from array import array
+
+
+class Milestone3FriendGraph:
+    # Undirected friend graph for the friend table. User ids are interned to ints once, and every friendship is one
+    # unsigned 64-bit entry (lower id << 32 | higher id) in an array, instead of a dict holding two 22-character
+    # strings per listed pair. Both users list the same friendship, so sorting the array and dropping repeats keeps
+    # one row per friendship (see unique_edges for how that stays within the arrays).
+    def __init__(self):
+        self.ids = {}
+        self.user_ids = []
+        # known[i] is 1 once user i has its own line in the user file; friends that never do would break the foreign
+        # key on friend, so their edges are dropped.
+        self.known = bytearray()
+        self.edges = array('Q')
+        self.listed = 0
+
+    def intern(self, user_id):
+        index = self.ids.get(user_id)
+        if index is None:
+            index = len(self.user_ids)
+            self.ids[user_id] = index
+            self.user_ids.append(user_id)
+            self.known.append(0)
+        return index
+
+    def add_user(self, user_id, friend_ids):
+        user = self.intern(user_id)
+        self.known[user] = 1
+        for friend_id in friend_ids:
+            self.listed += 1
+            friend = self.intern(friend_id)
+            if friend == user:
+                continue
+            low, high = (user, friend) if user < friend else (friend, user)
+            self.edges.append(low << 32 | high)
+
+    def unique_edges(self):
+        # Counting sort on the lower id into a second array, then each user's run is deduplicated on its own. Only one
+        # user's run is ever held as Python ints, so on top of the listed edges this needs about 17 bytes per edge (the
+        # bucketed copy and the growing result) plus 16 bytes per user. Sorting the whole array built a list of about
+        # 44 bytes per edge instead.
+        user_count = len(self.user_ids)
+        starts = array('Q', bytes(8 * (user_count + 1)))
+        for edge in self.edges:
+            starts[(edge >> 32) + 1] += 1
+        for user in range(user_count):
+            starts[user + 1] += starts[user]
+        positions = array('Q', starts)
+        by_user = array('Q', bytes(8 * len(self.edges)))
+        for edge in self.edges:
+            user = edge >> 32
+            by_user[positions[user]] = edge
+            positions[user] += 1
+        del positions
+        self.edges = array('Q')
+
+        edges = array('Q')
+        for user in range(user_count):
+            if not self.known[user]:
+                continue
+            for edge in sorted(set(by_user[starts[user]:starts[user + 1]])):
+                if self.known[edge & 0xFFFFFFFF]:
+                    edges.append(edge)
+        self.edges = edges
+        return edges
+
+    def edge_rows(self, edges, on_item=None):
+        friend_batch = []
+        for edge in edges:
+            friend_batch.append((self.user_ids[edge >> 32], self.user_ids[edge & 0xFFFFFFFF]))
+            if on_item is not None:
+                on_item()
+        return friend_batch
@@ -0,0 +1,139 @@
+import json
+import threading
+import time
+
+# Upper bounds in seconds of the insert latency histogram buckets. Anything slower lands in +Inf.
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class Milestone3Metrics:
+    # Counters for one loader run. Per-thread values live in one slot per thread so the hot path never takes a lock;
+    # per-table values are only touched once per committed batch and share one lock.
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.items = [0] * num_threads
+        self.parse_seconds = [0.0] * num_threads
+        self.table_rows = {}
+        self.insert_seconds = {}
+        # When each table's first insert started and its last one finished. A table's rows/sec is over that window,
+        # since with parallel phases most tables only load during part of the run.
+        self.table_started = {}
+        self.table_finished = {}
+        self.insert_buckets = {}
+        self.retries = {}
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.phase_seconds = {}
+
+    # ------------------------- Recording ------------------------------------------------------
+    def start(self):
+        # Called when the load itself starts, so elapsed_seconds leaves out the setup before it.
+        self.started = time.perf_counter()
+
+    def add_items(self, thread_idx, count=1):
+        self.items[thread_idx] += count
+
+    def items_done(self):
+        return sum(self.items)
+
+    def reset_items(self):
+        self.items = [0] * self.num_threads
+
+    def record_parse(self, thread_idx, seconds):
+        self.parse_seconds[thread_idx] += seconds
+
+    def record_insert(self, table, row_count, seconds):
+        finished = time.perf_counter()
+        with self.lock:
+            self.table_started[table] = min(self.table_started.get(table, finished - seconds), finished - seconds)
+            self.table_finished[table] = max(self.table_finished.get(table, finished), finished)
+            self.table_rows[table] = self.table_rows.get(table, 0) + row_count
+            self.insert_seconds[table] = self.insert_seconds.get(table, 0.0) + seconds
+            buckets = self.insert_buckets.setdefault(table, [0] * (len(LATENCY_BUCKETS) + 1))
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+                    break
+            else:
+                buckets[-1] += 1
+
+    def record_retry(self, table, reason):
+        with self.lock:
+            key = (table, reason)
+            self.retries[key] = self.retries.get(key, 0) + 1
+
+    def record_queue_depth(self, depth):
+        self.queue_depth = depth
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def record_phase(self, phase, seconds):
+        self.phase_seconds[phase] = seconds
+
+    # ------------------------- Export ------------------------------------------------------
+    def to_dict(self):
+        with self.lock:
+            elapsed = time.perf_counter() - self.started
+            tables = {}
+            for table, row_count in self.table_rows.items():
+                table_seconds = self.table_finished[table] - self.table_started[table]
+                tables[table] = {
+                    'rows': row_count,
+                    'seconds': table_seconds,
+                    'insert_seconds': self.insert_seconds[table],
+                    'rows_per_sec': row_count / table_seconds if table_seconds > 0 else 0.0,
+                    'latency_buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'],
+                                                self.insert_buckets[table])),
+                }
+            return {
+                'elapsed_seconds': elapsed,
+                'phase_seconds': dict(self.phase_seconds),
+                'parse_seconds_per_thread': list(self.parse_seconds),
+                'tables': tables,
+                'retries': [{'table': table, 'reason': reason, 'count': count}
+                            for (table, reason), count in self.retries.items()],
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+            }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self):
+        metrics = self.to_dict()
+        lines = ['# TYPE milestone3_phase_seconds gauge']
+        for phase, seconds in metrics['phase_seconds'].items():
+            lines.append(f'milestone3_phase_seconds{{phase="{phase}"}} {seconds}')
+        lines.append('# TYPE milestone3_parse_seconds_total counter')
+        for thread_idx, seconds in enumerate(metrics['parse_seconds_per_thread']):
+            lines.append(f'milestone3_parse_seconds_total{{thread="{thread_idx}"}} {seconds}')
+        lines.append('# TYPE milestone3_rows_inserted_total counter')
+        for table, values in metrics['tables'].items():
+            lines.append(f'milestone3_rows_inserted_total{{table="{table}"}} {values["rows"]}')
+        lines.append('# TYPE milestone3_rows_per_second gauge')
+        for table, values in metrics['tables'].items():
+            lines.append(f'milestone3_rows_per_second{{table="{table}"}} {values["rows_per_sec"]}')
+        lines.append('# TYPE milestone3_insert_seconds histogram')
+        for table, values in metrics['tables'].items():
+            # Prometheus buckets are cumulative.
+            cumulative = 0
+            for bound, count in values['latency_buckets'].items():
+                cumulative += count
+                lines.append(f'milestone3_insert_seconds_bucket{{table="{table}",le="{bound}"}} {cumulative}')
+            lines.append(f'milestone3_insert_seconds_sum{{table="{table}"}} {values["insert_seconds"]}')
+            lines.append(f'milestone3_insert_seconds_count{{table="{table}"}} {cumulative}')
+        lines.append('# TYPE milestone3_insert_retries_total counter')
+        for retry in metrics['retries']:
+            lines.append(f'milestone3_insert_retries_total{{table="{retry["table"]}",reason="{retry["reason"]}"}} '
+                         f'{retry["count"]}')
+        lines.append('# TYPE milestone3_queue_depth gauge')
+        lines.append(f'milestone3_queue_depth {metrics["queue_depth"]}')
+        lines.append('# TYPE milestone3_queue_depth_max gauge')
+        lines.append(f'milestone3_queue_depth_max {metrics["max_queue_depth"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # Prometheus text for .prom files, JSON for anything else.
+        with open(path, 'w') as f:
+            f.write(self.to_prometheus() if path.endswith('.prom') else self.to_json())
@@ -0,0 +1,99 @@
+# -------------------------------- GUI Queries --------------------------------------------
+# The SQL behind each MilestoneApp view, by name, so Milestone3Explain can check the same text the GUI runs.
+QUERIES = {
+    'states': 'select distinct state from business order by state;',
+    'cities': 'select distinct city from business where state=%s order by city;',
+    'zipcodes': """
+        select distinct fk_zipcode from business
+        where state = %s and city = %s
+        order by fk_zipcode
+    """,
+    # The categories and statistics of a zipcode come from the summaries Milestone3DB.refresh_zipcode_summaries
+    # keeps current after every load.
+    'categories': """
+        select fk_category
+        from zipcode_category_summary
+        where state = %s and city = %s and fk_zipcode = %s
+        order by fk_category
+    """,
+    # The businesses of a category are read a page at a time through a server-side cursor: the first page with
+    # 'businesses', every later one with 'businesses_page' starting after the (name, business_id) of the last row
+    # shown. business_id comes last and isn't displayed.
+    'businesses': """
+        select name, address, city, stars, review_count, num_checkins, business_id
+        from business b
+        inner join business_categories bc
+        on b.business_id = bc.fk_business_id
+        where state = %s and fk_zipcode = %s and bc.fk_category = %s
+        order by name, business_id
+    """,
+    'businesses_page': """
+        select name, address, city, stars, review_count, num_checkins, business_id
+        from business b
+        inner join business_categories bc
+        on b.business_id = bc.fk_business_id
+        where state = %s and fk_zipcode = %s and bc.fk_category = %s
+        and (name, business_id) > (%s, %s)
+        order by name, business_id
+    """,
+    'zipcode_statistics': """
+        select median_income, population, business_count
+        from zipcode_summary
+        where fk_zipcode = %s
+    """,
+    # Both rankings are kept current by Milestone3DB.refresh_zipcode_rankings after every load.
+    'popular': """
+        select name, stars, review_count
+        from zipcode_popular
+        where fk_zipcode = %s
+        order by rank
+    """,
+    'successful': """
+        select name, stars, review_count
+        from zipcode_successful
+        where fk_zipcode = %s
+        order by stars desc
+    """,
+    # Businesses with reviews matching a search, best match first: the summed rank of their matching reviews. city
+    # and zipcode may be null to search the whole state or city. The scope is applied before the reviews are grouped
+    # and ranked, so only the selection's reviews are ranked: found through the GIN index on review.text_search, or
+    # through review_business_idx from the selected businesses when that is fewer. Same columns as 'businesses', so
+    # the results go into the business table.
+    'search': """
+        select b.name, b.address, b.city, b.stars, b.review_count, b.num_checkins, b.business_id
+        from review r
+        inner join business b
+        on b.business_id = r.fk_business_id
+        cross join websearch_to_tsquery('english', %s) q
+        where r.text_search @@ q
+        and b.state = %s and b.city = coalesce(%s, b.city) and b.fk_zipcode = coalesce(%s, b.fk_zipcode)
+        group by b.business_id
+        order by sum(ts_rank(r.text_search, q)) desc, b.name
+        limit 100
+    """,
+}
+
+# The whole state -> city -> zipcode -> category hierarchy, which the GUI can prefetch into its cache at startup. It
+# reads all of business on purpose, so it isn't in QUERIES for Milestone3Explain to check. It is ordered like the
+# queries above, in the database's collation, so the cached lists come out in the same order as uncached ones.
+HIERARCHY_QUERY = """
+    select distinct b.state, b.city, b.fk_zipcode, bc.fk_category
+    from business b
+    left join business_categories bc
+    on b.business_id = bc.fk_business_id
+    order by b.state, b.city, b.fk_zipcode, bc.fk_category
+"""
+
+# The GUI selection each query's parameters come from, in order.
+QUERY_PARAMS = {
+    'states': [],
+    'cities': ['state'],
+    'zipcodes': ['state', 'city'],
+    'categories': ['state', 'city', 'zipcode'],
+    'businesses': ['state', 'zipcode', 'category'],
+    'businesses_page': ['state', 'zipcode', 'category', 'name', 'business_id'],
+    'zipcode_statistics': ['zipcode'],
+    'popular': ['zipcode'],
+    'successful': ['zipcode'],
+    'search': ['search', 'state', 'city', 'zipcode'],
+}
@@ -0,0 +1,46 @@
+import threading
+from collections import OrderedDict
+
+
+class Milestone3QueryCache:
+    # LRU cache of query results keyed by (query, parameters), holding at most max_entries results. version goes up
+    # on every clear, and a put made with an older version is dropped, so a result read before a load finished can't
+    # be cached after the load invalidated everything.
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, query, params):
+        # The cached rows, or None on a miss.
+        key = (query, tuple(params))
+        with self.lock:
+            rows = self.entries.get(key)
+            if rows is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return rows
+
+    def put(self, query, params, rows, version=None):
+        self.put_many([(query, params, rows)], version)
+
+    def put_many(self, entries, version=None):
+        with self.lock:
+            if version is not None and version != self.version:
+                return
+            for query, params, rows in entries:
+                key = (query, tuple(params))
+                self.entries[key] = rows
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.version += 1
@@ -0,0 +1,160 @@
+import threading
+
+import psycopg2
+from psycopg2 import pool, extensions, sql
+from PyQt6.QtCore import QObject, QRunnable, QSocketNotifier, QThreadPool, pyqtSignal
+
+from Milestone3QueryCache import Milestone3QueryCache
+from Milestone3QueryRegistry import Milestone3QueryRegistry
+
+
+class QueryTask(QRunnable):
+    def __init__(self, executor, key, generation, name, params, cache, fetch_size):
+        super().__init__()
+        self.executor = executor
+        self.key = key
+        self.generation = generation
+        self.name = name
+        self.params = params
+        self.cache = cache
+        self.fetch_size = fetch_size
+
+    def run(self):
+        self.executor.run_query(self.key, self.generation, self.name, self.params, self.cache, self.fetch_size)
+
+
+class Milestone3QueryExecutor(QObject):
+    # Runs the GUI's queries on a QThreadPool with a small connection pool, so the Qt event loop never waits on the
+    # database. Queries are named queries of a Milestone3QueryRegistry, which runs them as prepared statements.
+    # Every query is submitted under a key (one per view). Submitting under the same key again supersedes
+    # the earlier query: if it is still running it is cancelled on the server, and its result is dropped either way.
+    # Queries submitted with cache=True are answered from an LRU cache when they were run before with the same
+    # parameters, which invalidate_on clears whenever the loader reports new data. Queries submitted with a fetch_size
+    # run through a server-side cursor and deliver only their first fetch_size rows. A query that fails emits failed
+    # and, if it is still current, calls the error_callback it was submitted with.
+    finished = pyqtSignal(str, int, object)
+    failed = pyqtSignal(str, int, str)
+    invalidated = pyqtSignal()
+
+    def __init__(self, max_connections=4, cache_size=1024, registry=None, **connect_kwargs):
+        super().__init__()
+        self.registry = registry if registry is not None else Milestone3QueryRegistry()
+        self.connect_kwargs = connect_kwargs
+        self.connection_pool = psycopg2.pool.ThreadedConnectionPool(minconn=1, maxconn=max_connections,
+                                                                    **connect_kwargs)
+        # One thread per connection, so a task never waits on the pool.
+        self.thread_pool = QThreadPool()
+        self.thread_pool.setMaxThreadCount(max_connections)
+        self.lock = threading.Lock()
+        self.generations = {}
+        self.callbacks = {}
+        self.error_callbacks = {}
+        # key -> (generation, connection) of the query running for it.
+        self.running = {}
+        self.cache = Milestone3QueryCache(cache_size)
+        # Connection that LISTENs for the loader's notifications, see invalidate_on.
+        self.listener = None
+        self.notifier = None
+        # The executor lives on the GUI thread, so results emitted from pool threads are delivered there.
+        self.finished.connect(self.deliver)
+        self.failed.connect(self.deliver_error)
+
+    def submit(self, key, name, params, callback, cache=False, fetch_size=None, error_callback=None):
+        rows = self.cache.get(name, params) if cache else None
+        with self.lock:
+            generation = self.generations.get(key, 0) + 1
+            self.generations[key] = generation
+            self.callbacks[key] = callback
+            self.error_callbacks[key] = error_callback
+            self.cancel_running(key)
+        # A cached result is delivered right away, still superseding whatever was in flight for the key.
+        if rows is not None:
+            callback(rows)
+            return
+        self.thread_pool.start(QueryTask(self, key, generation, name, params, cache, fetch_size))
+
+    def cancel(self, *keys):
+        # For views that were just cleared: whatever is in flight for them is stale.
+        with self.lock:
+            for key in keys:
+                self.generations[key] = self.generations.get(key, 0) + 1
+                self.cancel_running(key)
+
+    def cancel_running(self, key):
+        # Called with the lock held, so the connection can't be handed to another query in between.
+        running = self.running.get(key)
+        if running is not None:
+            running[1].cancel()
+
+    def is_current(self, key, generation):
+        with self.lock:
+            return self.generations.get(key) == generation
+
+    def run_query(self, key, generation, name, params, cache, fetch_size):
+        # Runs on a pool thread. A query that was superseded while it waited for a thread is never sent.
+        if not self.is_current(key, generation):
+            return
+        cache_version = self.cache.version
+        connection = self.connection_pool.getconn()
+        try:
+            with self.lock:
+                if self.generations.get(key) != generation:
+                    return
+                self.running[key] = (generation, connection)
+            try:
+                rows = self.registry.run(connection, name, params, fetch_size)
+                connection.commit()
+            except psycopg2.extensions.QueryCanceledError as e:
+                connection.rollback()
+                # Only a superseded query is cancelled on purpose, so a current one hit a statement timeout.
+                if self.is_current(key, generation):
+                    self.failed.emit(key, generation, str(e))
+                return
+            except Exception as e:
+                connection.rollback()
+                self.failed.emit(key, generation, str(e))
+                return
+            finally:
+                with self.lock:
+                    if self.running.get(key, (None, None))[0] == generation:
+                        del self.running[key]
+            if cache:
+                self.cache.put(name, params, rows, cache_version)
+            self.finished.emit(key, generation, rows)
+        finally:
+            self.connection_pool.putconn(connection)
+
+    def deliver(self, key, generation, rows):
+        # A result superseded on its way to the GUI thread is dropped here.
+        if self.is_current(key, generation):
+            self.callbacks[key](rows)
+
+    def deliver_error(self, key, generation, message):
+        if self.is_current(key, generation) and self.error_callbacks.get(key) is not None:
+            self.error_callbacks[key](message)
+
+    def invalidate_on(self, channel):
+        # Clear the cache whenever a NOTIFY arrives on channel. The listening connection's socket is watched by the
+        # event loop, so notifications are read on the GUI thread without polling.
+        self.listener = psycopg2.connect(**self.connect_kwargs)
+        self.listener.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with self.listener.cursor() as cursor:
+            cursor.execute(sql.SQL('listen {}').format(sql.Identifier(channel)))
+        self.notifier = QSocketNotifier(self.listener.fileno(), QSocketNotifier.Type.Read)
+        self.notifier.activated.connect(self.read_notifications)
+
+    def read_notifications(self):
+        self.listener.poll()
+        if not self.listener.notifies:
+            return
+        self.listener.notifies.clear()
+        self.cache.clear()
+        self.invalidated.emit()
+
+    def close(self):
+        if self.listener is not None:
+            self.notifier.setEnabled(False)
+            self.listener.close()
+        self.cancel(*list(self.generations))
+        self.thread_pool.waitForDone()
+        self.connection_pool.closeall()
@@ -0,0 +1,77 @@
+import re
+import threading
+import time
+import weakref
+
+from psycopg2 import sql
+
+from Milestone3Queries import HIERARCHY_QUERY, QUERIES
+
+
+class Milestone3QueryRegistry:
+    # Runs the named queries of Milestone3Queries as prepared statements. Each query is PREPAREd the first time it
+    # runs on a connection and EXECUTEd from then on, so PostgreSQL parses it once per connection instead of once
+    # per click. Records the calls and latency of every query; report() prints them.
+    def __init__(self, queries=None):
+        if queries is None:
+            queries = dict(QUERIES, hierarchy=HIERARCHY_QUERY)
+        self.queries = queries
+        self.lock = threading.Lock()
+        # connection -> names of the queries prepared on it. Weak, so a closed connection's entry goes with it.
+        self.prepared = weakref.WeakKeyDictionary()
+        # name -> [calls, total seconds, max seconds]
+        self.stats = {}
+
+    def parameter_count(self, name):
+        return self.queries[name].count('%s')
+
+    def prepare(self, connection, name):
+        with self.lock:
+            names = self.prepared.setdefault(connection, set())
+            if name in names:
+                return
+        # PREPARE takes $1, $2, ... where psycopg2 takes %s.
+        numbers = iter(range(1, self.parameter_count(name) + 1))
+        text = re.sub(r'%s', lambda match: f'${next(numbers)}', self.queries[name])
+        with connection.cursor() as cursor:
+            cursor.execute(sql.SQL('prepare {} as ').format(sql.Identifier(name)) + sql.SQL(text))
+        with self.lock:
+            names.add(name)
+
+    def statement(self, name):
+        # EXECUTE of the prepared query, with placeholders for its parameters.
+        count = self.parameter_count(name)
+        if count == 0:
+            return sql.SQL('execute {}').format(sql.Identifier(name))
+        return sql.SQL('execute {} ({})').format(sql.Identifier(name), sql.SQL(', ').join([sql.Placeholder()] * count))
+
+    def run(self, connection, name, params, fetch_size=None):
+        # All rows of the query, or with fetch_size only the first fetch_size rows, read through a server-side cursor.
+        started = time.perf_counter()
+        if fetch_size is None:
+            self.prepare(connection, name)
+            with connection.cursor() as cursor:
+                cursor.execute(self.statement(name), params)
+                rows = cursor.fetchall()
+        else:
+            # DECLARE only takes a query, not an EXECUTE, so a server-side cursor runs the query text. A named cursor
+            # is planned for its first rows, and closing it after one fetch stops the server from producing the rest.
+            with connection.cursor(name=name) as cursor:
+                cursor.execute(self.queries[name], params)
+                rows = cursor.fetchmany(fetch_size)
+        self.record(name, time.perf_counter() - started)
+        return rows
+
+    def record(self, name, seconds):
+        with self.lock:
+            stats = self.stats.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def report(self):
+        with self.lock:
+            stats = sorted(self.stats.items(), key=lambda item: -item[1][1])
+        print(f'{"query":<24} {"calls":>7} {"mean ms":>9} {"max ms":>9}')
+        for name, (calls, total, longest) in stats:
+            print(f'{name:<24} {calls:>7} {total / calls * 1000:>9.2f} {longest * 1000:>9.2f}')
@@ -0,0 +1,136 @@
+import json
+import os
+import random
+import string
+
+# -------------------------------- Table Sizes --------------------------------------------
+# Row counts of the real load (Kyle_Lim_TableSizes.txt). A scale factor of 1.0 generates files of the same size and
+# the child tables keep the same ratio to their parents.
+BUSINESSES = 11481
+USERS = 192999
+REVIEWS = 416479
+CATEGORIES = 226
+CATEGORIES_PER_BUSINESS = 33619 / BUSINESSES
+HOURS_PER_BUSINESS = 55502 / BUSINESSES
+CHECKIN_DAYS_PER_BUSINESS = 67407 / BUSINESSES
+CHECKIN_HOURS_PER_DAY = 481360 / 67407
+FRIENDS_PER_USER = 1052706 / USERS
+
+DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+STATES = ['AZ', 'NV', 'OH', 'NC', 'PA', 'WI']
+WORDS = ['food', 'great', 'service', 'place', 'good', 'time', 'back', 'really', 'staff', 'order', 'best', 'nice',
+         'friendly', 'restaurant', 'menu', "didn't", 'chicken', 'delicious', 'amazing', 'price']
+
+
+class Milestone3SyntheticData:
+    def __init__(self, scale=0.01, seed=0):
+        self.scale = scale
+        self.random = random.Random(seed)
+        self.business_count = max(int(BUSINESSES * scale), 1)
+        self.user_count = max(int(USERS * scale), 2)
+        self.review_count = max(int(REVIEWS * scale), 1)
+        # The business table references zipcode, so the benchmark has to insert these before loading.
+        self.zipcodes = sorted({'%05d' % self.random.randint(10000, 99999)
+                                for _ in range(max(self.business_count // 20, 1))})
+
+    # ------------------------- Helper Methods ------------------------------------------------------
+    def random_id(self):
+        # Yelp ids are 22 url-safe characters.
+        return ''.join(self.random.choices(string.ascii_letters + string.digits + '-_', k=22))
+
+    def sample_count(self, mean, maximum=None):
+        # Round mean up or down at random so the counts average out to exactly mean.
+        count = int(mean) + (1 if self.random.random() < mean - int(mean) else 0)
+        return min(count, maximum) if maximum is not None else count
+
+    def text(self, word_count):
+        return ' '.join(self.random.choices(WORDS, k=word_count)).capitalize() + '.'
+
+    def write_lines(self, file_path, items):
+        with open(file_path, 'w') as f:
+            for item in items:
+                f.write(json.dumps(item))
+                f.write('\n')
+
+    # ------------------------- Generators ------------------------------------------------------
+    def generate(self, output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+        categories = ['Category %d' % i for i in range(CATEGORIES)]
+        cities = {state: ['%s City %d' % (state, i) for i in range(5)] for state in STATES}
+        business_ids = [self.random_id() for _ in range(self.business_count)]
+        user_ids = [self.random_id() for _ in range(self.user_count)]
+
+        self.write_lines(os.path.join(output_dir, 'yelp_business.JSON'),
+                         self.businesses(business_ids, categories, cities))
+        self.write_lines(os.path.join(output_dir, 'yelp_user.JSON'), self.users(user_ids))
+        self.write_lines(os.path.join(output_dir, 'yelp_review.JSON'), self.reviews(business_ids, user_ids))
+        self.write_lines(os.path.join(output_dir, 'yelp_checkin.JSON'), self.checkins(business_ids))
+
+    def businesses(self, business_ids, categories, cities):
+        for business_id in business_ids:
+            state = self.random.choice(STATES)
+            days = self.random.sample(DAYS, self.sample_count(HOURS_PER_BUSINESS, len(DAYS)))
+            yield {
+                'business_id': business_id,
+                'name': self.text(2)[:-1],
+                'address': '%d %s St' % (self.random.randint(1, 9999), self.random.choice(WORDS).capitalize()),
+                'city': self.random.choice(cities[state]),
+                'state': state,
+                'postal_code': self.random.choice(self.zipcodes),
+                'latitude': round(self.random.uniform(30, 45), 6),
+                'longitude': round(self.random.uniform(-120, -75), 6),
+                'categories': self.random.sample(categories,
+                                                 self.sample_count(CATEGORIES_PER_BUSINESS, len(categories))),
+                'hours': {day: '9:0-17:0' for day in days},
+            }
+
+    def users(self, user_ids):
+        # Friendships are symmetric in the real data, so every edge goes into both users' lists.
+        friends = {user_id: [] for user_id in user_ids}
+        for _ in range(int(len(user_ids) * FRIENDS_PER_USER / 2)):
+            user_id, friend_id = self.random.sample(user_ids, 2)
+            friends[user_id].append(friend_id)
+            friends[friend_id].append(user_id)
+
+        for user_id in user_ids:
+            yield {
+                'user_id': user_id,
+                'name': self.random.choice(WORDS).capitalize(),
+                'yelping_since': '%d-%02d-%02d' % (self.random.randint(2004, 2017), self.random.randint(1, 12),
+                                                   self.random.randint(1, 28)),
+                'review_count': self.random.randint(0, 500),
+                'fans': self.random.randint(0, 50),
+                'average_stars': round(self.random.uniform(1, 5), 2),
+                'funny': self.random.randint(0, 100),
+                'useful': self.random.randint(0, 100),
+                'cool': self.random.randint(0, 100),
+                'friends': friends[user_id],
+            }
+
+    def reviews(self, business_ids, user_ids):
+        for _ in range(self.review_count):
+            yield {
+                'review_id': self.random_id(),
+                'user_id': self.random.choice(user_ids),
+                'business_id': self.random.choice(business_ids),
+                'stars': self.random.randint(1, 5),
+                'date': '%d-%02d-%02d' % (self.random.randint(2005, 2018), self.random.randint(1, 12),
+                                          self.random.randint(1, 28)),
+                # Real reviews average around a hundred words.
+                'text': self.text(self.random.randint(20, 200)),
+                'useful': self.random.randint(0, 10),
+                'funny': self.random.randint(0, 10),
+                'cool': self.random.randint(0, 10),
+            }
+
+    def checkins(self, business_ids):
+        for business_id in business_ids:
+            days = self.random.sample(DAYS, self.sample_count(CHECKIN_DAYS_PER_BUSINESS, len(DAYS)))
+            yield {
+                'business_id': business_id,
+                'time': {day: self.checkin_hours() for day in days},
+            }
+
+    def checkin_hours(self):
+        hours = self.random.sample(range(24), self.sample_count(CHECKIN_HOURS_PER_DAY, 24))
+        return {'%d:00' % hour: self.random.randint(1, 20) for hour in hours}
@@ -0,0 +1,65 @@
+from PyQt6.QtCore import QAbstractTableModel, QModelIndex, Qt
+
+
+class Milestone3TableModel(QAbstractTableModel):
+    # Table model over query result rows. The rows are kept as the tuples the query returned and a cell's text is
+    # only built when the view asks for it, which it does for the visible cells alone, so filling a table costs the
+    # same for ten rows as for tens of thousands. formats has one format string per column, e.g. 'Stars: {}'; rows
+    # may have more values than there are columns, and those aren't shown.
+    # Rows can also arrive a page at a time: with fetch_more set and has_more true, the view asks for the next page
+    # when it is scrolled to the bottom, and fetch_more is called with the last row so far.
+    def __init__(self, formats, fetch_more=None, parent=None):
+        super().__init__(parent)
+        self.formats = formats
+        self.rows = []
+        self.fetch_more = fetch_more
+        self.has_more = False
+        self.fetching = False
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.formats)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if role != Qt.ItemDataRole.DisplayRole or not index.isValid():
+            return None
+        return self.formats[index.column()].format(self.rows[index.row()][index.column()])
+
+    def canFetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.fetch_more is None:
+            return False
+        return self.has_more and not self.fetching
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        self.fetching = True
+        self.fetch_more(self.rows[-1])
+
+    def fetch_failed(self):
+        # The page never came, so the next scroll to the bottom asks for it again.
+        self.fetching = False
+
+    def set_rows(self, rows, has_more=False):
+        self.beginResetModel()
+        self.rows = rows
+        self.has_more = has_more and len(rows) > 0
+        self.fetching = False
+        self.endResetModel()
+
+    def append_rows(self, rows, has_more=False):
+        if rows:
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(rows) - 1)
+            self.rows.extend(rows)
+            self.endInsertRows()
+        self.has_more = has_more and len(rows) > 0
+        self.fetching = False
+
+    def clear(self):
+        self.set_rows([])